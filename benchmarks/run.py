@@ -0,0 +1,279 @@
+import os
+import sys
+import json
+import time
+import random
+import resource
+import tempfile
+import platform
+import subprocess
+from absl import app, flags
+
+# Benchmarks of LLEMBA's own overhead on synthetic corpora, run with `python -m benchmarks.run` from the repository root.
+# Every (benchmark, size) case runs in a fresh process so that the peak RSS belongs to that case alone.
+
+flags.DEFINE_list('benchmarks', None, 'Benchmarks to run, all of them by default.')
+flags.DEFINE_list('sizes', ['1000', '10000', '100000'], 'Corpus sizes in segments, up to 1000000.')
+flags.DEFINE_string('output', 'benchmarks/results.json', 'File to write the results to as JSON.')
+flags.DEFINE_string('baseline', 'benchmarks/baseline.json', 'Stored results to compare against, skipped if the file does not exist.')
+flags.DEFINE_bool('save_baseline', False, 'Store the results as the new baseline.')
+flags.DEFINE_float('tolerance', 0.2, 'Relative throughput drop or p99 increase reported as a regression.')
+flags.DEFINE_float('latency_ms', 50.0, 'Median latency of the simulated backend in the end_to_end benchmark.')
+flags.DEFINE_integer('concurrency', 256, 'Concurrency of the end_to_end benchmark.')
+flags.DEFINE_integer('startup_runs', 20, 'Number of cold starts timed by the startup benchmark, which ignores --sizes.')
+flags.DEFINE_string('case', None, 'Internal: run a single benchmark:size case and print its result.')
+
+WORDS = "the of translation quality model score segment source target meaning grammar a to in is was for on with as by at from this that".split()
+
+
+def synthetic_segments(size, seed=0):
+    rng = random.Random(seed)
+    for _ in range(size):
+        yield ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 40)))
+
+
+def synthetic_answers(size, kind, seed=0):
+    rng = random.Random(seed)
+    for _ in range(size):
+        score = rng.randint(0, 100)
+        stars = rng.randint(1, 5)
+        if kind == "number":
+            yield rng.choice([f"{score}", f"Score: {score}", f"I would rate this translation {score} out of 100.", f"{score}/100"])
+        elif kind == "stars":
+            yield rng.choice(["★" * stars, f"{stars} stars", "*" * stars, "Four stars: minor issues."])
+        elif kind == "classes":
+            yield rng.choice(["Perfect translation", "Some meaning preserved and understandable", "Most meaning preserved, minor issues", "No meaning preserved"])
+        else:
+            yield rng.choice(["Critical:\nno-error\nMajor:\naccuracy/mistranslation - \"involvement\"\nMinor:\nfluency/grammar - \"wäre\"\n",
+                              "Critical:\nno-error\nMajor:\nno-error\nMinor:\nstyle/awkward - \"etc.,\"\n"])
+
+
+def measure(items, call):
+    # per item latencies of call(item), returns (seconds, latencies)
+    latencies = []
+    start = time.perf_counter()
+    for item in items:
+        t = time.perf_counter()
+        call(item)
+        latencies.append(time.perf_counter() - t)
+    return time.perf_counter() - start, latencies
+
+
+def bench_templates(size):
+    from llemba.llemba_mqm_utils import TEMPLATE_LLEMBA_MQM, compile_template
+    from llemba.prompt import prompts
+
+    results = {}
+    for name, template in [("da", prompts["LLEMBA-DA"]["prompt"]), ("mqm", TEMPLATE_LLEMBA_MQM)]:
+        compiled = compile_template(template, 'Czech', 'English')
+        results[name] = measure(synthetic_segments(size), lambda s: compiled.render(s, s))
+    return results
+
+
+def bench_parsers(size):
+    from llemba.prompt import prompts
+    from llemba.llemba_mqm_utils import parse_mqm_answer
+
+    parsers = {
+        "number": prompts["LLEMBA-DA"]["validate_answer"],
+        "stars": prompts["LLEMBA-stars"]["validate_answer"],
+        "classes": prompts["LLEMBA-classes"]["validate_answer"],
+        "mqm": lambda x: parse_mqm_answer(x, list_mqm_errors=False, full_desc=True),
+    }
+    return {name: measure(synthetic_answers(size, name), parse) for name, parse in parsers.items()}
+
+
+def bench_cache(size):
+    from llemba.cache import ResponseCache
+    from llemba.backends import FakeBackend
+    from llemba.together_api import TogetherApi
+    from llemba.prompt import prompts
+
+    method = prompts["LLEMBA-DA"]
+    togetherapi = TogetherApi(backend=FakeBackend())
+    with tempfile.TemporaryDirectory() as directory:
+        cache = ResponseCache(directory)
+        prompt_list = [method["prompt"].format(source_lang='Czech', target_lang='English', source_seg=s, target_seg=s) for s in synthetic_segments(size)]
+        request = lambda prompt: togetherapi.request(prompt, "fake", method["validate_answer"], cache=cache, max_tokens=method["max_tokens"], stop=method["stop"])
+        for prompt in prompt_list:
+            request(prompt)
+        # the measured pass only hits the cache
+        result = {"hit": measure(prompt_list, request)}
+        cache.close()
+    return result
+
+
+def bench_end_to_end(size):
+    from llemba.cache import ResponseCache
+    from llemba.backends import FakeBackend
+    from llemba.together_api import TogetherApi
+    from llemba.utils import iter_llemba_scores
+
+    FLAGS = flags.FLAGS
+    backend = FakeBackend(latency_ms=FLAGS.latency_ms)
+    latencies = []
+
+    # time every request to the simulated backend
+    acreate = backend.acreate
+
+    async def timed_acreate(**parameters):
+        t = time.perf_counter()
+        response = await acreate(**parameters)
+        latencies.append(time.perf_counter() - t)
+        return response
+    backend.acreate = timed_acreate
+
+    togetherapi = TogetherApi(backend=backend)
+    with tempfile.TemporaryDirectory() as directory:
+        cache = ResponseCache(directory)
+        pairs = zip(synthetic_segments(size, seed=1), synthetic_segments(size, seed=2))
+        start = time.perf_counter()
+        for _ in iter_llemba_scores(pairs, 'Czech', 'English', 'LLEMBA-DA', 'fake', concurrency=FLAGS.concurrency, togetherapi=togetherapi, cache=cache):
+            pass
+        seconds = time.perf_counter() - start
+        cache.close()
+    return {"fake_backend": (seconds, latencies)}
+
+
+def bench_hedging(size):
+    # one request in a hundred stalls for a hundred times the median latency, the latencies are the ones callers see
+    from llemba.hedging import Hedger
+    from llemba.backends import FakeBackend
+    from llemba.together_api import TogetherApi
+    from llemba.utils import iter_llemba_scores
+
+    FLAGS = flags.FLAGS
+
+    def run(hedger):
+        backend = FakeBackend(latency_ms=FLAGS.latency_ms, stall_rate=0.01, stall_seconds=FLAGS.latency_ms / 10)
+        togetherapi = TogetherApi(backend=backend, hedger=hedger)
+        latencies = []
+        acall_with_retries = togetherapi.acall_with_retries
+
+        async def timed_acall_with_retries(*args, **kwargs):
+            t = time.perf_counter()
+            response = await acall_with_retries(*args, **kwargs)
+            latencies.append(time.perf_counter() - t)
+            return response
+        togetherapi.acall_with_retries = timed_acall_with_retries
+
+        pairs = zip(synthetic_segments(size, seed=1), synthetic_segments(size, seed=2))
+        start = time.perf_counter()
+        for _ in iter_llemba_scores(pairs, 'Czech', 'English', 'LLEMBA-DA', 'fake', concurrency=FLAGS.concurrency, togetherapi=togetherapi, cache={}):
+            pass
+        return time.perf_counter() - start, latencies
+
+    return {"unhedged": run(None), "hedged": run(Hedger(quantile=0.95, budget=0.05))}
+
+
+def bench_startup(size):
+    # size is the number of cold starts of a fresh interpreter, for --help, the library import and a cache-only rerun
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory() as directory:
+        segments = os.path.join(directory, 'segments.txt')
+        with open(segments, 'w') as f:
+            f.write('\n'.join(synthetic_segments(10)) + '\n')
+        score = [sys.executable, os.path.join(root, 'main.py'), f'--source={segments}', f'--hypothesis={segments}', '--source_lang=Czech', '--target_lang=English',
+                 '--method=LLEMBA-DA', '--model=fake', '--backend=fake', f'--cache_dir={directory}/cache', f'--journal_dir={directory}/journal', f'--output={directory}/scores.txt']
+        commands = {
+            "help": [sys.executable, os.path.join(root, 'main.py'), '--help'],
+            "import": [sys.executable, '-c', 'import llemba.utils'],
+            "rerun": score,
+        }
+        # fill the cache so that the measured reruns do not call the backend
+        subprocess.run(score, check=True, cwd=root, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        # absl exits with status 1 after printing --help
+        return {name: measure(range(size), lambda _: subprocess.run(command, check=name != "help", cwd=root, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)) for name, command in commands.items()}
+
+
+BENCHMARKS = {
+    "templates": bench_templates,
+    "parsers": bench_parsers,
+    "cache": bench_cache,
+    "end_to_end": bench_end_to_end,
+    "hedging": bench_hedging,
+    "startup": bench_startup,
+}
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def run_case(name, size):
+    results = []
+    for variant, (seconds, latencies) in BENCHMARKS[name](size).items():
+        results.append({
+            "benchmark": f"{name}/{variant}",
+            "size": size,
+            "seconds": seconds,
+            "throughput": size / seconds if seconds > 0 else None,
+            "p50_us": percentile(latencies, 0.50) * 1e6 if latencies else None,
+            "p99_us": percentile(latencies, 0.99) * 1e6 if latencies else None,
+        })
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mb = peak_rss / 2 ** 20 if sys.platform == 'darwin' else peak_rss / 2 ** 10
+    for result in results:
+        result["peak_rss_mb"] = peak_rss_mb
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    stored = {(r["benchmark"], r["size"]): r for r in baseline["results"]}
+    for result in results:
+        old = stored.get((result["benchmark"], result["size"]))
+        if old is None:
+            continue
+        result["baseline_throughput"] = old["throughput"]
+        if old["throughput"] and result["throughput"] < old["throughput"] * (1 - tolerance):
+            regressions.append(f"{result['benchmark']} ({result['size']}): throughput {result['throughput']:.0f}/s, baseline {old['throughput']:.0f}/s")
+        if old.get("p99_us") and result["p99_us"] and result["p99_us"] > old["p99_us"] * (1 + tolerance):
+            regressions.append(f"{result['benchmark']} ({result['size']}): p99 {result['p99_us']:.1f}us, baseline {old['p99_us']:.1f}us")
+    return regressions
+
+
+def main(argv):
+    FLAGS = flags.FLAGS
+    if FLAGS.case is not None:
+        name, size = FLAGS.case.split(':')
+        print(json.dumps(run_case(name, int(size))))
+        return
+
+    names = FLAGS.benchmarks or list(BENCHMARKS)
+    results = []
+    for name in names:
+        assert name in BENCHMARKS, f"Unknown benchmark {name}."
+        for size in [FLAGS.startup_runs] if name == "startup" else FLAGS.sizes:
+            args = [sys.executable, '-m', 'benchmarks.run', f'--case={name}:{size}', f'--latency_ms={FLAGS.latency_ms}', f'--concurrency={FLAGS.concurrency}']
+            output = subprocess.run(args, check=True, stdout=subprocess.PIPE, text=True).stdout
+            for result in json.loads(output.strip().splitlines()[-1]):
+                print(f"{result['benchmark']:<24} {result['size']:>8} {result['throughput']:>12.0f}/s  p50 {result['p50_us'] or 0:>10.1f}us  p99 {result['p99_us'] or 0:>10.1f}us  {result['peak_rss_mb']:>8.1f}MB", file=sys.stderr)
+                results.append(result)
+
+    report = {"timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'), "python": platform.python_version(), "machine": platform.machine(), "results": results}
+
+    regressions = []
+    if os.path.isfile(FLAGS.baseline):
+        with open(FLAGS.baseline) as f:
+            regressions = compare(results, json.load(f), FLAGS.tolerance)
+        report["regressions"] = regressions
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+
+    with open(FLAGS.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    if FLAGS.save_baseline:
+        with open(FLAGS.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    app.run(main)
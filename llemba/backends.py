@@ -0,0 +1,373 @@
+import os
+import sys
+import json
+import math
+import time
+import random
+import hashlib
+from types import SimpleNamespace
+from absl import app, flags
+
+# A backend turns the chat completion parameters built by together_api.build_parameters into a response object with
+# the shape of the Together SDK (response.choices[i].message.content, .finish_reason, response.usage). TogetherApi only
+# talks to backends, so the same retry, cache and throughput code runs against Together, any OpenAI-compatible server or
+# the in-process fake used for benchmarks and offline runs.
+
+BACKENDS = ["together", "openai", "fake", "replay"]
+
+
+class TogetherBackend:
+    # timeout is the limit in seconds of a single request, the SDK default if not set
+    # a trailing assistant turn is not extended, answers that are cut off are requested again with a larger budget
+    continues_final_message = False
+
+    def __init__(self, api_key=None, timeout=None):
+        from together import Together
+
+        self.api_key = api_key or os.getenv('TOGETHER_API_KEY')
+        if not self.api_key:
+            raise ValueError("API key not found. Please set the TOGETHER_API_KEY environment variable.")
+        self.options = {"timeout": timeout} if timeout is not None else {}
+        self.client = Together(api_key=self.api_key, max_retries=0, **self.options)  # retries are handled by TogetherApi
+        # the async client is bound to the event loop it is first used in, so it is created lazily and closed by aclose
+        self.async_client = None
+
+    def create(self, **parameters):
+        return self.client.chat.completions.create(**parameters)
+
+    async def acreate(self, **parameters):
+        if self.async_client is None:
+            from together import AsyncTogether
+            self.async_client = AsyncTogether(api_key=self.api_key, max_retries=0, **self.options)
+        return await self.async_client.chat.completions.create(**parameters)
+
+    async def aclose(self):
+        if self.async_client is not None:
+            await self.async_client.close()
+            self.async_client = None
+
+
+class BackendHTTPError(Exception):
+    # carries status_code and headers so that the retry logic treats it like the SDK errors
+    def __init__(self, status_code, headers=None, body=None):
+        super().__init__(f"HTTP {status_code}: {body}")
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.body = body
+
+
+def to_namespace(data):
+    if isinstance(data, dict):
+        return SimpleNamespace(**{k: to_namespace(v) for k, v in data.items()})
+    if isinstance(data, list):
+        return [to_namespace(v) for v in data]
+    return data
+
+
+class OpenAICompatibleBackend:
+    # POSTs to <base_url>/chat/completions of any OpenAI-compatible server (vLLM, llama.cpp, the fake server below, ...)
+    continues_final_message = True
+
+    def __init__(self, base_url, api_key=None, timeout=600.0):
+        import httpx
+
+        self.url = base_url.rstrip('/') + '/chat/completions'
+        self.headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        self.timeout = timeout
+        self.client = httpx.Client(timeout=timeout)
+        self.async_client = None
+
+    def parse(self, response):
+        if response.status_code >= 400:
+            raise BackendHTTPError(response.status_code, response.headers, response.text)
+        return to_namespace(response.json())
+
+    def body(self, parameters):
+        # the OpenAI API asks for top-k logprobs with logprobs=true and top_logprobs=k
+        logprobs = parameters.get("logprobs")
+        if isinstance(logprobs, int) and not isinstance(logprobs, bool):
+            parameters = dict(parameters, logprobs=True, top_logprobs=logprobs)
+        # a trailing assistant turn has to be extended instead of followed by a new turn (vLLM's chat template options)
+        if parameters["messages"][-1]["role"] == "assistant":
+            parameters = dict(parameters, continue_final_message=True, add_generation_prompt=False)
+        return parameters
+
+    def create(self, **parameters):
+        return self.parse(self.client.post(self.url, json=self.body(parameters), headers=self.headers))
+
+    async def acreate(self, **parameters):
+        if self.async_client is None:
+            import httpx
+            self.async_client = httpx.AsyncClient(timeout=self.timeout, limits=httpx.Limits(max_connections=None))
+        return self.parse(await self.async_client.post(self.url, json=self.body(parameters), headers=self.headers))
+
+    async def aclose(self):
+        if self.async_client is not None:
+            await self.async_client.aclose()
+            self.async_client = None
+
+
+class CacheMiss(Exception):
+    pass
+
+
+class ReplayBackend:
+    # Cache-only runs without credentials or network: every request has to be answered by the response cache, a request
+    # that reaches the backend is a cache miss
+    def create(self, **parameters):
+        raise CacheMiss(f"Request to {parameters['model']} at temperature {parameters['temperature']} is not in the cache.")
+
+    async def acreate(self, **parameters):
+        return self.create(**parameters)
+
+    async def aclose(self):
+        pass
+
+
+def request_hash(parameters):
+    return hashlib.sha256(json.dumps(parameters, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def default_answer(parameters):
+    # a DA-style score that only depends on the last message, so the same prompt always gets the same answer
+    content = parameters["messages"][-1]["content"]
+    digest = hashlib.sha256(content.encode('utf-8')).digest()
+    if "identify error types" in content:
+        return fake_mqm_answer(digest)
+    return str(digest[0] * 101 // 256)
+
+
+def fake_mqm_answer(digest):
+    # error spans in the format of the MQM few-shot answers: a critical error in one of 16 answers, up to two major
+    # errors in half of them and up to two minor errors
+    counts = [int(digest[1] < 16), digest[2] % 3 if digest[2] < 128 else 0, digest[3] % 3]
+    sections = []
+    for severity, count in zip(["Critical", "Major", "Minor"], counts):
+        sections.append(f"{severity}:")
+        sections += [f'accuracy/mistranslation - "span {i + 1}"' for i in range(count)] or ["no-error"]
+    return "\n".join(sections)
+
+
+def fake_top_logprobs(token, k):
+    # the answer gets most of the probability, a number is spread to its neighbours, the rest goes to a token that is no score
+    if token.isdigit():
+        number = int(token)
+        candidates = [(token, 0.6), (str(number + 1), 0.15), (str(max(number - 1, 0)), 0.15), ("The", 0.1)]
+    else:
+        candidates = [(token, 0.9), ("The", 0.1)]
+    merged = {}
+    for candidate, probability in candidates:
+        merged[candidate] = merged.get(candidate, 0.0) + probability
+    return [{"token": candidate, "logprob": math.log(probability)} for candidate, probability in list(merged.items())[:k]]
+
+
+class FakeBackend:
+    # Deterministic in-process stand-in: latency, errors and answers only depend on the seed, the request and how often
+    # the same request was sent before, never on the order in which concurrent requests happen to arrive.
+    #   latency_ms, latency_sigma: lognormal latency with the given median
+    #   error_rate, rate_limit_rate: share of calls failing with a 500 or a 429 (with Retry-After of retry_after seconds)
+    #   stall_rate, stall_seconds: share of calls that stall for stall_seconds on top of their latency
+    #   timeout: calls slower than this many seconds fail with TimeoutError after the timeout, like an HTTP client would
+    #   answers: dict of substring -> canned answer, looked up in the last message; rule: function(parameters) -> answer
+    # Concurrent copies of the same request (hedges) get draws of their own.
+    continues_final_message = True
+
+    def __init__(self, latency_ms=0.0, latency_sigma=0.5, error_rate=0.0, rate_limit_rate=0.0, retry_after=1.0, answers=None, rule=None, seed=0, stall_rate=0.0, stall_seconds=30.0, timeout=None):
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.stall_rate = stall_rate
+        self.stall_seconds = stall_seconds
+        self.timeout = timeout
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.answers = answers or {}
+        self.rule = rule or default_answer
+        self.seed = seed
+        # failed attempts per request that has not succeeded yet, so a retry gets a fresh draw
+        self.failures = {}
+        # copies of each request currently in flight
+        self.inflight = {}
+        self.num_calls = 0
+
+    def answer(self, parameters):
+        messages = parameters["messages"]
+        # a trailing assistant turn is a continuation request, so only the part that is still missing is generated
+        partial = messages[-1]["content"] if messages[-1]["role"] == "assistant" else ""
+        request = dict(parameters, messages=messages[:-1]) if partial else parameters
+
+        content = request["messages"][-1]["content"]
+        text = None
+        for pattern, canned in self.answers.items():
+            if pattern in content:
+                text = canned
+                break
+        if text is None:
+            text = self.rule(request)
+        return text[len(partial):] if text.startswith(partial) else text
+
+    def outcome(self, key, copy=0):
+        self.num_calls += 1
+        attempt = self.failures.get(key, 0)
+        rng = random.Random(f"{self.seed}:{attempt}:{key}" if copy == 0 else f"{self.seed}:{attempt}:{copy}:{key}")
+
+        latency = 0.0
+        if self.latency_ms > 0:
+            latency = self.latency_ms / 1000.0 * math.exp(rng.gauss(0, self.latency_sigma))
+        error = None
+        draw = rng.random()
+        if draw < self.rate_limit_rate:
+            error = BackendHTTPError(429, {"retry-after": str(self.retry_after)}, "rate limit exceeded")
+        elif draw < self.rate_limit_rate + self.error_rate:
+            error = BackendHTTPError(500, {}, "internal server error")
+        # the stall draw comes last so that runs without stalls keep their latencies and errors
+        if self.stall_rate > 0 and rng.random() < self.stall_rate:
+            latency += self.stall_seconds
+        if self.timeout is not None and latency > self.timeout:
+            latency = self.timeout
+            error = TimeoutError(f"Request timed out after {self.timeout}s.")
+
+        if error is not None:
+            self.failures[key] = attempt + 1
+        else:
+            self.failures.pop(key, None)
+        return latency, error
+
+    def response(self, parameters):
+        text = self.answer(parameters)
+        finish_reason = "stop"
+        for stop in parameters.get("stop") or []:
+            if stop in text:
+                text = text[:text.index(stop)]
+        # whitespace separated words stand in for tokens
+        words = text.split(' ')
+        max_tokens = parameters.get("max_tokens")
+        if max_tokens is not None and len(words) > max_tokens:
+            text = ' '.join(words[:max_tokens]) + ' '
+            words = words[:max_tokens]
+            finish_reason = "length"
+        prompt_tokens = sum(len(m["content"]) for m in parameters["messages"]) // 4 + 1
+        choice = {"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": finish_reason}
+        # logprobs in either the Together (k) or the OpenAI (true and top_logprobs=k) form
+        top_logprobs = parameters.get("top_logprobs") if parameters.get("logprobs") is True else parameters.get("logprobs")
+        if top_logprobs:
+            candidates = fake_top_logprobs(words[0], top_logprobs)
+            choice["logprobs"] = {"content": [{"token": words[0], "logprob": candidates[0]["logprob"], "top_logprobs": candidates}]}
+        return to_namespace({
+            "choices": [choice],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(words), "total_tokens": prompt_tokens + len(words)},
+        })
+
+    def enter(self, key):
+        copy = self.inflight.get(key, 0)
+        self.inflight[key] = copy + 1
+        return copy
+
+    def leave(self, key):
+        self.inflight[key] -= 1
+        if self.inflight[key] == 0:
+            del self.inflight[key]
+
+    def create(self, **parameters):
+        key = request_hash(parameters)
+        try:
+            latency, error = self.outcome(key, self.enter(key))
+            time.sleep(latency)
+        finally:
+            self.leave(key)
+        if error is not None:
+            raise error
+        return self.response(parameters)
+
+    async def acreate(self, **parameters):
+        import asyncio
+
+        key = request_hash(parameters)
+        try:
+            latency, error = self.outcome(key, self.enter(key))
+            await asyncio.sleep(latency)
+        finally:
+            self.leave(key)
+        if error is not None:
+            raise error
+        return self.response(parameters)
+
+    async def aclose(self):
+        pass
+
+
+# timeout is the limit in seconds of a single request, the default of each backend if not set
+def make_backend(name="together", base_url=None, api_key=None, timeout=None, **fake_options):
+    if name == "together":
+        return TogetherBackend(api_key, timeout=timeout)
+    elif name == "openai":
+        assert base_url is not None, "The openai backend needs a base url."
+        if timeout is not None:
+            return OpenAICompatibleBackend(base_url, api_key or os.getenv('OPENAI_API_KEY'), timeout=timeout)
+        return OpenAICompatibleBackend(base_url, api_key or os.getenv('OPENAI_API_KEY'))
+    elif name == "fake":
+        return FakeBackend(timeout=timeout, **fake_options)
+    elif name == "replay":
+        return ReplayBackend()
+    raise ValueError(f"Unknown backend {name}.")
+
+
+def serve(backend, host='127.0.0.1', port=8000):
+    # OpenAI-compatible HTTP server answering POST /v1/chat/completions from an in-process (fake) backend
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            if not self.path.rstrip('/').endswith('/chat/completions'):
+                return self.reply(404, {"error": "not found"})
+            try:
+                parameters = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            except json.JSONDecodeError:
+                # also happens when the client goes away before sending the body
+                return self.reply(400, {"error": "invalid json"})
+            try:
+                response = backend.create(**parameters)
+            except BackendHTTPError as e:
+                return self.reply(e.status_code, {"error": e.body}, e.headers)
+            self.reply(200, json.loads(json.dumps(response, default=vars)))
+
+        def reply(self, status, body, headers=None):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    print(f"Serving a fake OpenAI-compatible API on http://{host}:{port}/v1", file=sys.stderr)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def main(argv):
+    FLAGS = flags.FLAGS
+    backend = FakeBackend(latency_ms=FLAGS.fake_latency_ms, error_rate=FLAGS.fake_error_rate, rate_limit_rate=FLAGS.fake_rate_limit_rate, seed=FLAGS.fake_seed,
+                          stall_rate=FLAGS.fake_stall_rate, stall_seconds=FLAGS.fake_stall_seconds)
+    serve(backend, FLAGS.host, FLAGS.port)
+
+
+if __name__ == "__main__":
+    flags.DEFINE_string('host', '127.0.0.1', 'Address to listen on.')
+    flags.DEFINE_integer('port', 8000, 'Port to listen on.')
+    flags.DEFINE_float('fake_latency_ms', 0.0, 'Median latency of the fake backend in milliseconds.')
+    flags.DEFINE_float('fake_error_rate', 0.0, 'Share of requests failing with HTTP 500.')
+    flags.DEFINE_float('fake_rate_limit_rate', 0.0, 'Share of requests failing with HTTP 429.')
+    flags.DEFINE_float('fake_stall_rate', 0.0, 'Share of requests that stall for --fake_stall_seconds.')
+    flags.DEFINE_float('fake_stall_seconds', 30.0, 'How long stalled requests take on top of their latency.')
+    flags.DEFINE_integer('fake_seed', 0, 'Seed of the fake backend.')
+    app.run(main)
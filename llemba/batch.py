@@ -0,0 +1,119 @@
+import re
+import sys
+import json
+from absl import app, flags
+
+from llemba.cache import request_key
+from llemba.backends import BACKENDS, CacheMiss, BackendHTTPError, to_namespace
+
+# Two-phase scoring through batch inference endpoints. --emit_batch runs the normal scoring loop against BatchRecorder,
+# which writes every request that is not cached to a provider-style batch JSONL file, with the cache key as custom_id.
+# Once the provider has answered, --ingest_batch stores the answers of the result file in the cache under the same keys
+# and the scores come from the cache. Answers that do not parse ask for a higher temperature, which the next
+# --emit_batch writes out, exactly as an interactive run would escalate.
+
+BATCH_URL = "/v1/chat/completions"
+KEY_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+
+class BatchRecorder:
+    # backend that answers nothing and records what would have been sent, each distinct request once
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'w', encoding='utf-8')
+        self.recorded = set()
+
+    def create(self, **parameters):
+        key = request_key(parameters)
+        if key not in self.recorded:
+            self.recorded.add(key)
+            self.file.write(json.dumps({"custom_id": key, "method": "POST", "url": BATCH_URL, "body": parameters}, ensure_ascii=False) + '\n')
+        raise CacheMiss(f"Request {key} was added to the batch {self.path}.")
+
+    async def acreate(self, **parameters):
+        return self.create(**parameters)
+
+    async def aclose(self):
+        pass
+
+    def close(self):
+        self.file.close()
+
+
+# result lines follow the OpenAI/Together batch output: {"custom_id", "response": {"status_code", "body"}, "error"}
+def parse_result_line(line):
+    entry = json.loads(line)
+    key = entry.get("custom_id")
+    if not isinstance(key, str) or not KEY_PATTERN.match(key):
+        raise ValueError(f"Result line without a valid custom_id: {line[:100]}")
+    response = entry.get("response") or {}
+    status = response.get("status_code", 200)
+    if entry.get("error") or status != 200 or "body" not in response:
+        return key, None
+    return key, to_namespace(response["body"])
+
+
+# stores the answers of a batch result file in the cache, answers go through the same post-processing as API answers
+def ingest_batch(togetherapi, cache, path):
+    counts = {"ingested": 0, "existing": 0, "failed": 0}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                key, response = parse_result_line(line)
+            except (json.JSONDecodeError, ValueError) as e:
+                print(f"Skipping result line: {e}", file=sys.stderr)
+                counts["failed"] += 1
+                continue
+            if response is None:
+                counts["failed"] += 1
+                continue
+            if key in cache:
+                counts["existing"] += 1
+                continue
+            # answers of expected-score requests are stored with their logprobs, like request_expected does
+            if any(getattr(choice, "logprobs", None) for choice in response.choices):
+                answers = togetherapi.logprob_answers(response)
+            else:
+                answers = togetherapi.parse_response(response)
+                if len(answers) == 1:
+                    answers[0]["completion_tokens"] = togetherapi.completion_tokens(response)
+                answers = togetherapi.finalize_answers(answers)
+            togetherapi.cache_store(cache, key, answers, getattr(response, "model", None))
+            counts["ingested"] += 1
+    return counts
+
+
+# answers a batch request file with a backend, to test the batch mode locally (e.g. with the fake backend)
+def answer_batch(backend, requests_path, results_path):
+    answered = 0
+    with open(requests_path, 'r', encoding='utf-8') as requests, open(results_path, 'w', encoding='utf-8') as results:
+        for line in requests:
+            request = json.loads(line)
+            try:
+                body = json.loads(json.dumps(backend.create(**request["body"]), default=vars))
+                response, error = {"status_code": 200, "body": dict(body, model=request["body"]["model"])}, None
+            except BackendHTTPError as e:
+                response, error = {"status_code": e.status_code, "body": None}, {"message": str(e.body)}
+            results.write(json.dumps({"id": f"batch_req_{answered}", "custom_id": request["custom_id"], "response": response, "error": error}, ensure_ascii=False) + '\n')
+            answered += 1
+    return answered
+
+
+def main(argv):
+    from llemba.backends import make_backend
+
+    FLAGS = flags.FLAGS
+    assert FLAGS.requests is not None and FLAGS.results is not None, "Batch request and result files must be provided."
+    backend = make_backend(FLAGS.backend, base_url=FLAGS.base_url)
+    answered = answer_batch(backend, FLAGS.requests, FLAGS.results)
+    print(f"Answered {answered} requests of {FLAGS.requests} into {FLAGS.results}.", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    flags.DEFINE_string('requests', None, 'Batch request file written by main.py --emit_batch.')
+    flags.DEFINE_string('results', None, 'Batch result file to write.')
+    flags.DEFINE_enum('backend', 'fake', BACKENDS, 'Backend answering the requests one by one.')
+    flags.DEFINE_string('base_url', None, 'Base url of the OpenAI-compatible server.')
+    app.run(main)
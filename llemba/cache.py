@@ -0,0 +1,222 @@
+import io
+import os
+import sys
+import gzip
+import json
+import hashlib
+from absl import app, flags
+from termcolor import colored
+
+DEFAULT_CACHE_DIR = 'cache/responses'
+DEFAULT_SIZE_LIMIT = 10 * 2 ** 30
+EVICTION_POLICIES = ['least-recently-stored', 'least-recently-used', 'least-frequently-used', 'none']
+
+# the hit/miss counters are written to disk in batches so that a lookup does not cost a database write
+STATS_FLUSH_EVERY = 1000
+
+
+def request_key(parameters):
+    # content address of a request: everything that is sent to the model except the transport flags
+    canonical = {k: v for k, v in parameters.items() if k != "stream"}
+    data = json.dumps(canonical, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    # API answers keyed by request_key, shared by all methods and models, with bounded size
+    # size_limit and eviction_policy of None keep the settings stored in an existing cache
+    def __init__(self, directory=DEFAULT_CACHE_DIR, size_limit=DEFAULT_SIZE_LIMIT, eviction_policy='least-recently-stored'):
+        settings = {"tag_index": True}
+        if size_limit is not None:
+            settings["size_limit"] = int(size_limit)
+        if eviction_policy is not None:
+            assert eviction_policy in EVICTION_POLICIES, f"Unknown eviction policy {eviction_policy}."
+            settings["eviction_policy"] = eviction_policy
+        import diskcache as dc
+
+        self.directory = directory
+        self.cache = dc.Cache(directory, **settings)
+        self.counters = dc.Cache(os.path.join(directory, 'stats'), eviction_policy='none')
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        value = self.cache.get(key, default)
+        if value is default:
+            self.misses += 1
+        else:
+            self.hits += 1
+        if self.hits + self.misses >= STATS_FLUSH_EVERY:
+            self.flush_stats()
+        return value
+
+    def set(self, key, value, tag=None):
+        # the tag is the model name, it is used for the per-model statistics
+        self.cache.set(key, value, tag=tag)
+
+    def __contains__(self, key):
+        return key in self.cache
+
+    def __len__(self):
+        return len(self.cache)
+
+    def flush_stats(self):
+        hits, misses = self.hits, self.misses
+        self.hits, self.misses = 0, 0
+        if hits:
+            self.counters.incr('hits', hits)
+        if misses:
+            self.counters.incr('misses', misses)
+
+    def stats(self):
+        self.flush_stats()
+        hits = self.counters.get('hits', 0)
+        misses = self.counters.get('misses', 0)
+        models = dict(self.cache._sql('SELECT tag, COUNT(*) FROM Cache GROUP BY tag').fetchall())
+        return {
+            "directory": self.directory,
+            "entries": len(self.cache),
+            "size_bytes": self.cache.volume(),
+            "size_limit": self.cache.size_limit,
+            "eviction_policy": self.cache.eviction_policy,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses > 0 else None,
+            "models": {str(model): count for model, count in models.items()},
+        }
+
+    def close(self):
+        self.flush_stats()
+        self.cache.close()
+        self.counters.close()
+
+
+SNAPSHOT_FORMAT = "llemba-cache"
+SNAPSHOT_VERSION = 1
+
+
+def answers_digest(answers):
+    data = json.dumps(answers, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+# snapshots are JSON lines, compressed according to the file extension (.zst needs the zstandard package)
+def open_snapshot(path, mode):
+    if path.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("Snapshots ending in .zst require the zstandard package (pip install zstandard), use .jsonl.gz otherwise.")
+        if mode == 'w':
+            return io.TextIOWrapper(zstandard.ZstdCompressor(level=10).stream_writer(open(path, 'wb')), encoding='utf-8')
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb')), encoding='utf-8')
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def export_cache(cache, path):
+    exported = 0
+    with open_snapshot(path, 'w') as f:
+        f.write(json.dumps({"format": SNAPSHOT_FORMAT, "version": SNAPSHOT_VERSION}) + '\n')
+        for key in cache.cache.iterkeys():
+            answers, model = cache.cache.get(key, tag=True)
+            # entries can be evicted while iterating
+            if answers is None or not isinstance(key, str):
+                continue
+            entry = {"key": key, "model": model, "answers": answers, "sha256": answers_digest(answers)}
+            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            exported += 1
+        f.write(json.dumps({"entries": exported}) + '\n')
+    return exported
+
+
+# merges a snapshot into the cache, keys that are already cached are kept and corrupted entries are skipped
+def import_cache(cache, path):
+    counts = {"imported": 0, "existing": 0, "corrupted": 0}
+    complete = False
+    with open_snapshot(path, 'r') as f:
+        header = json.loads(f.readline())
+        if header.get("format") != SNAPSHOT_FORMAT or header.get("version") != SNAPSHOT_VERSION:
+            raise ValueError(f"{path} is not a cache snapshot of version {SNAPSHOT_VERSION}.")
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                counts["corrupted"] += 1
+                continue
+            if "key" not in entry:
+                complete = entry.get("entries") == counts["imported"] + counts["existing"] + counts["corrupted"]
+                continue
+            if len(entry["key"]) != 64 or answers_digest(entry["answers"]) != entry["sha256"]:
+                counts["corrupted"] += 1
+                continue
+            if entry["key"] in cache:
+                counts["existing"] += 1
+                continue
+            cache.set(entry["key"], entry["answers"], tag=entry["model"])
+            counts["imported"] += 1
+    if not complete:
+        print(colored(f"Snapshot {path} is truncated or its entry count does not match, imported what could be verified.", "red"), file=sys.stderr)
+    return counts
+
+
+# copies a per-method cache of older versions (keyed by model, prompt and temperature) into the response cache
+def migrate_legacy_cache(cache, legacy_dir, max_tokens=500):
+    import diskcache as dc
+    from llemba.together_api import build_parameters
+
+    legacy = dc.Cache(legacy_dir)
+    migrated = 0
+    for legacy_key in legacy.iterkeys():
+        request = dict(legacy_key)
+        answers = legacy.get(legacy_key)
+        if not answers:
+            continue
+        key = request_key(build_parameters(request["prompt"], request["model"], request["temperature"], max_tokens))
+        if key not in cache:
+            cache.set(key, answers, tag=request["model"])
+            migrated += 1
+    legacy.close()
+    return migrated
+
+
+def main(argv):
+    FLAGS = flags.FLAGS
+    commands = ["stats", "migrate", "export", "import"]
+    if len(argv) != 2 or argv[1] not in commands:
+        print(f"Usage: python -m llemba.cache <{'|'.join(commands)}> [--cache_dir=...]", file=sys.stderr)
+        sys.exit(1)
+
+    if os.path.isdir(FLAGS.cache_dir):
+        # keep the stored settings, the commands must not change the size limit or eviction policy of a cache
+        cache = ResponseCache(FLAGS.cache_dir, size_limit=None, eviction_policy=None)
+    elif argv[1] in ["import", "migrate"]:
+        cache = ResponseCache(FLAGS.cache_dir)
+    else:
+        print(f"Cache directory {FLAGS.cache_dir} does not exist.", file=sys.stderr)
+        sys.exit(1)
+
+    if argv[1] == "stats":
+        print(json.dumps(cache.stats(), indent=2))
+    elif argv[1] == "migrate":
+        assert FLAGS.legacy_dir is not None, "Legacy cache directory must be provided."
+        migrated = migrate_legacy_cache(cache, FLAGS.legacy_dir, FLAGS.legacy_max_tokens)
+        print(f"Migrated {migrated} entries from {FLAGS.legacy_dir}.", file=sys.stderr)
+    elif argv[1] == "export":
+        assert FLAGS.snapshot is not None, "Snapshot file must be provided."
+        exported = export_cache(cache, FLAGS.snapshot)
+        print(f"Exported {exported} entries to {FLAGS.snapshot}.", file=sys.stderr)
+    elif argv[1] == "import":
+        assert FLAGS.snapshot is not None, "Snapshot file must be provided."
+        counts = import_cache(cache, FLAGS.snapshot)
+        print(f"Imported {counts['imported']} entries from {FLAGS.snapshot}, {counts['existing']} were already cached and {counts['corrupted']} failed verification.", file=sys.stderr)
+    cache.close()
+
+
+if __name__ == "__main__":
+    flags.DEFINE_string('cache_dir', DEFAULT_CACHE_DIR, 'Directory of the response cache.')
+    flags.DEFINE_string('snapshot', None, 'Snapshot file to export to or import from (.jsonl, .jsonl.gz or .jsonl.zst).')
+    flags.DEFINE_string('legacy_dir', None, 'Per-method cache directory of an older version, e.g. cache/<model>_<method>.')
+    flags.DEFINE_integer('legacy_max_tokens', 500, 'max_tokens that the legacy cache entries were requested with.')
+    app.run(main)
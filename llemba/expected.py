@@ -0,0 +1,50 @@
+import math
+
+# Expected-score mode: one request per segment with max_tokens=1 that asks for the top-k logprobs of the first token.
+# The score is the expectation of the values of the valid score tokens under their renormalized probabilities, so it is
+# continuous and there is nothing to parse or retry at a higher temperature.
+
+EXPECTED_TOP_LOGPROBS = 20
+
+
+def as_dict(value):
+    if isinstance(value, dict):
+        return value
+    return dict(vars(value))
+
+
+# top-k logprobs of the first generated token as {token: logprob}, from the OpenAI chat format
+# (logprobs.content[0].top_logprobs) or Together's, whose top_logprobs is a dict for the generated token (or a list of
+# dicts, one per token) on the logprobs or on the choice itself
+def first_token_logprobs(choice):
+    logprobs = getattr(choice, "logprobs", None)
+    content = getattr(logprobs, "content", None)
+    if content:
+        return {entry.token: entry.logprob for entry in content[0].top_logprobs or [content[0]]}
+    top_logprobs = getattr(logprobs, "top_logprobs", None) or getattr(choice, "top_logprobs", None)
+    if isinstance(top_logprobs, (list, tuple)):
+        top_logprobs = top_logprobs[0] if top_logprobs else None
+    if top_logprobs:
+        return {token: logprob for token, logprob in as_dict(top_logprobs).items()}
+    # only the sampled token is known
+    tokens = getattr(logprobs, "tokens", None)
+    token_logprobs = getattr(logprobs, "token_logprobs", None)
+    if tokens and token_logprobs:
+        return {tokens[0]: token_logprobs[0]}
+    return None
+
+
+# values maps answer tokens (without surrounding whitespace) to scores, None if no valid token is among the top-k
+def expected_score(top_logprobs, values):
+    total = 0.0
+    weighted = 0.0
+    for token, logprob in top_logprobs.items():
+        value = values.get(token.strip())
+        if value is None:
+            continue
+        probability = math.exp(logprob)
+        total += probability
+        weighted += probability * value
+    if total == 0.0:
+        return None
+    return weighted / total
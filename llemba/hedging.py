@@ -0,0 +1,72 @@
+import time
+import asyncio
+import collections
+
+# Hedged requests: an API call that has not returned once the quantile of the recent latencies of its model has passed
+# gets a duplicate, the first valid response is used and the other call is cancelled. Hedges are limited to budget
+# times the number of calls, so the call volume rises by a few percent at most while a straggler no longer holds up
+# the end of a run. Only the async path hedges, the sync path has a single call in flight anyway.
+
+
+class Hedger:
+    def __init__(self, quantile=0.95, budget=0.05, window=1000, min_samples=50, metrics=None):
+        self.quantile = quantile
+        self.budget = budget
+        self.window = window
+        # no hedging until the latencies of the model are known well enough
+        self.min_samples = min_samples
+        self.metrics = metrics
+        self.latencies = {}
+        self.observed = {}
+        self.delays = {}
+        self.calls = 0
+        self.hedges = 0
+
+    def observe(self, model, seconds):
+        latencies = self.latencies.get(model)
+        if latencies is None:
+            latencies = self.latencies[model] = collections.deque(maxlen=self.window)
+        latencies.append(seconds)
+        self.observed[model] = self.observed.get(model, 0) + 1
+        # the quantile is recomputed every few calls rather than on every one
+        if self.observed[model] >= self.min_samples and self.observed[model] % 10 == 0:
+            ordered = sorted(latencies)
+            self.delays[model] = ordered[min(len(ordered) - 1, int(self.quantile * len(ordered)))]
+
+    def delay(self, model):
+        return self.delays.get(model)
+
+    # create is a function returning a new coroutine of the call, it is called again for the hedge
+    async def call(self, model, create):
+        self.calls += 1
+        delay = self.delay(model)
+        start = time.perf_counter()
+        tasks = [asyncio.ensure_future(create())]
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done and self.hedges < self.budget * self.calls:
+                    self.hedges += 1
+                    tasks.append(asyncio.ensure_future(create()))
+            response, winner = await first_valid(tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+        if len(tasks) > 1 and self.metrics is not None:
+            self.metrics.inc("llemba_hedges_total", model=model, winner="hedge" if winner > 0 else "primary")
+        self.observe(model, time.perf_counter() - start)
+        return response
+
+
+# the result and position of the first task that succeeds, the first error if all of them fail
+async def first_valid(tasks):
+    pending = set(tasks)
+    error = None
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in sorted(done, key=tasks.index):
+            if task.exception() is None:
+                return task.result(), tasks.index(task)
+            if error is None:
+                error = task.exception()
+    raise error
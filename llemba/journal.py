@@ -0,0 +1,70 @@
+import os
+import json
+import hashlib
+
+
+def file_fingerprint(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+# the journal of a run is identified by the content of both input files and everything that changes the scores
+def journal_path(directory, source, hypothesis, source_lang, target_lang, methods, model, pack=1, expected=False):
+    key = {
+        "source": file_fingerprint(source),
+        "hypothesis": file_fingerprint(hypothesis),
+        "source_lang": source_lang,
+        "target_lang": target_lang,
+        "methods": list(methods),
+        "model": model,
+    }
+    # packed scores can differ from single ones, unpacked runs keep the journals of older versions
+    if pack > 1:
+        key["pack"] = pack
+    if expected:
+        key["expected"] = True
+    digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+    return os.path.join(directory, f"{digest[:32]}.jsonl")
+
+
+class Journal:
+    # Append-only record of finished segments, one JSON object per line, so that a killed run can be resumed
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.completed = {}
+        if resume and os.path.isfile(path):
+            self.completed = self.load()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.file = open(path, 'a' if resume else 'w', encoding='utf-8')
+        if resume and self.file.tell() > 0 and not self.ends_with_newline():
+            self.file.write('\n')
+
+    def load(self):
+        completed = {}
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line may be cut off if the run was killed while writing it
+                    continue
+                completed[entry["index"]] = entry["score"]
+        return completed
+
+    def ends_with_newline(self):
+        with open(self.path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+
+    def append(self, index, score, **metadata):
+        entry = {"index": index, "score": score}
+        entry.update(metadata)
+        self.file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self.file.flush()
+        self.completed[index] = score
+
+    def close(self):
+        self.file.close()
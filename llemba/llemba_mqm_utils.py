@@ -1,6 +1,7 @@
-import ipdb
+import sys
 import json
 import re
+import string
 from collections import defaultdict
 
 def apply_template(template, data):
@@ -16,6 +17,59 @@ def apply_template(template, data):
     else:
         raise ValueError(f"Unknown template type {type(template)}")
 
+# A template compiled for one language pair. The language fields are filled in once, what is left is a format string with
+# only the segment fields. For chat templates, turns without segment fields are rendered once and the same dicts are
+# shared by every prompt, so the few-shot prefix is not copied per segment.
+class CompiledTemplate:
+    def __init__(self, template, source_lang, target_lang):
+        languages = {'source_lang': source_lang, 'target_lang': target_lang}
+        if isinstance(template, str):
+            self.turns = None
+            self.text = compile_fields(template, languages)[0]
+        elif isinstance(template, list):
+            self.turns = []
+            for conversation_turn in template:
+                text, has_segments = compile_fields(conversation_turn['content'], languages)
+                if has_segments:
+                    self.turns.append((conversation_turn['role'], text))
+                else:
+                    self.turns.append(dict(conversation_turn, content=text.format()))
+        else:
+            raise ValueError(f"Unknown template type {type(template)}")
+
+    def render(self, source_seg, target_seg):
+        if self.turns is None:
+            return self.text.format(source_seg=source_seg, target_seg=target_seg)
+        return [{"role": turn[0], "content": turn[1].format(source_seg=source_seg, target_seg=target_seg)} if isinstance(turn, tuple) else turn for turn in self.turns]
+
+    def render_many(self, source_segs, target_segs):
+        # renders whole columns of segments
+        if self.turns is None:
+            render = self.text.format
+            return [render(source_seg=s, target_seg=t) for s, t in zip(source_segs, target_segs)]
+        return [self.render(s, t) for s, t in zip(source_segs, target_segs)]
+
+
+def compile_fields(text, languages):
+    # fills in the language fields and keeps the others as fields, returns the new format string and whether any are left
+    parts = []
+    has_fields = False
+    for literal, field, spec, conversion in string.Formatter().parse(text):
+        parts.append(literal.replace('{', '{{').replace('}', '}}'))
+        if field is None:
+            continue
+        if field in languages:
+            parts.append(format(languages[field], spec).replace('{', '{{').replace('}', '}}'))
+        else:
+            has_fields = True
+            parts.append('{' + field + ('!' + conversion if conversion else '') + (':' + spec if spec else '') + '}')
+    return ''.join(parts), has_fields
+
+
+def compile_template(template, source_lang, target_lang):
+    return CompiledTemplate(template, source_lang, target_lang)
+
+
 def parse_broken_json(x):
     improved_translation = ""
     errors = defaultdict(list)
@@ -45,38 +99,67 @@ def parse_broken_json(x):
     return {"improved translation": improved_translation, "errors": errors}
 
 
+# error classes in order of precedence with their subclasses, the last matching subclass wins
+ERROR_CLASSES = [
+    ("accuracy", ["addition", "mistranslation", "omission", "untranslated text"]),
+    ("fluency", ["character encoding", "grammar", "inconsistency", "punctuation", "register", "spelling"]),
+    ("locale convention", ["currency", "date", "name", "telephone", "time"]),
+    ("style", []),
+    ("terminology", ["inappropriate", "inconsistent"]),
+    ("non-translation", []),
+    ("other", []),
+]
+ERROR_CLASS_PREFIXES = tuple(name for name, _ in ERROR_CLASSES)
+SEVERITY_HEADERS = {"critical:": "critical", "major:": "major", "minor:": "minor"}
+MQM_MAX_TOKENS = 256
+
+
 def parse_error_class(error):
     # parse error from error description, errors are ['accuracy', 'fluency', 'locale convention', 'style', 'terminology', 'non-translation', 'other']
     #  locale convention (currency, date, name, telephone, or time format), style (awkward), terminology (inappropriate for context, inconsistent use),
-    class_name = "unknown"
-    if "accuracy" in error:
-        class_name = "accuracy"
-        for subclass in ["addition", "mistranslation", "omission", "untranslated text"]:
-            if subclass in error:
-                class_name = f"accuracy-{subclass}"
-    elif "fluency" in error:
-        class_name = "fluency"
-        for subclass in ["character encoding", "grammar", "inconsistency", "punctuation", "register", "spelling"]:
-            if subclass in error:
-                class_name = f"fluency-{subclass}"
-    elif "locale convention" in error:
-        class_name = "locale convention"
-        for subclass in ["currency", "date", "name", "telephone", "time"]:
-            if subclass in error:
-                class_name = f"locale convention-{subclass}"
-    elif "style" in error:
-        class_name = "style"
-    elif "terminology" in error:
-        class_name = "terminology"
-        for subclass in ["inappropriate", "inconsistent"]:
-            if subclass in error:
-                class_name = f"terminology-{subclass}"
-    elif "non-translation" in error:
-        class_name = "non-translation"
-    elif "other" in error:
-        class_name = "other"
-
-    return class_name
+    for name, subclasses in ERROR_CLASSES:
+        if name in error:
+            class_name = name
+            for subclass in subclasses:
+                if subclass in error:
+                    class_name = f"{name}-{subclass}"
+            return class_name
+    return "unknown"
+
+
+# single pass over the lines of a plain text answer, collecting the error lines under their severity
+# None if a non-empty answer has neither a severity section nor a no-error line (a refusal, free text or a bare number),
+# so that it is retried instead of getting the best score
+def parse_mqm_errors(x):
+    errors = {'critical': [], 'major': [], 'minor': []}
+    error_level = None
+    recognized = False
+    for line in x.lower().split('\n'):
+        line = line.strip()
+        if "" == line:
+            continue
+        if "no-error" in line or "no error" in line:
+            recognized = True
+            continue
+        if line in SEVERITY_HEADERS:
+            error_level = SEVERITY_HEADERS[line]
+            recognized = True
+            continue
+
+        if not line.startswith(ERROR_CLASS_PREFIXES) and ("critical" in line or "major" in line or "minor" in line):
+            print(line, file=sys.stderr)
+
+        if error_level is None:
+            print(f"No error level for {line}", file=sys.stderr)
+            continue
+
+        if "non-translation" in line:
+            errors["critical"].append(line)
+        else:
+            errors[error_level].append(line)
+    if not recognized and x.strip():
+        return None
+    return errors
 
 
 def parse_mqm_answer(x, list_mqm_errors=False, full_desc=True):
@@ -90,38 +173,10 @@ def parse_mqm_answer(x, list_mqm_errors=False, full_desc=True):
         except:
             x = parse_broken_json(x)
         errors = x["errors"]
-
-
     else:
-        x = x.lower()
-        errors = {'critical': [], 'major': [], 'minor': []}
-        error_level = None
-        for line in x.split('\n'):
-            line = line.strip()
-            if "no-error" in line or "no error" in line or "" == line:
-                continue
-            if "critical:" == line:
-                error_level = "critical"
-                continue
-            elif "major:" == line:
-                error_level = "major"
-                continue
-            elif "minor:" == line:
-                error_level = "minor"
-                continue
-
-            if "critical" in line or "major" in line or "minor" in line:
-                if not any([line.startswith(x) for x in ['accuracy', 'fluency', 'locale convention', 'style', 'terminology', 'non-translation', 'other']]):
-                    print(line)
-
-            if error_level is None:
-                print(f"No error level for {line}")
-                continue
-
-            if "non-translation" in line:
-                errors["critical"].append(line)
-            else:
-                errors[error_level].append(line)
+        errors = parse_mqm_errors(x)
+        if errors is None:
+            return None
 
     error_classes = defaultdict(list)
     final_score = 0
@@ -134,6 +189,9 @@ def parse_mqm_answer(x, list_mqm_errors=False, full_desc=True):
                 final_score += 25 if error_level == 'critical' else 5 if error_level == 'major' else 1
                 error_counter += 1
 
+            # the classes are only returned when listing errors
+            if not list_mqm_errors:
+                continue
             if full_desc:
                 error_classes[error_level].append(error)
             else:
@@ -0,0 +1,143 @@
+import os
+import json
+import bisect
+import threading
+
+from llemba.rate_limiter import error_status_code
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0]
+
+HELP = {
+    "llemba_api_seconds": "Latency of single API calls, including failed attempts.",
+    "llemba_api_calls_total": "API calls by outcome (ok or the error class).",
+    "llemba_retries_total": "API calls that were retried, by error class.",
+    "llemba_failed_requests_total": "Requests left without an answer after an error that is not retried or after the last attempt, by error class.",
+    "llemba_prompt_tokens_total": "Prompt tokens reported by the API.",
+    "llemba_completion_tokens_total": "Completion tokens reported by the API.",
+    "llemba_cache_lookups_total": "Response cache lookups by result (hit or miss).",
+    "llemba_continuations_total": "Requests continuing an answer that was cut off by max_tokens.",
+    "llemba_parse_failures_total": "Answers the method could not parse.",
+    "llemba_escalation_depth_total": "Finished requests by the number of temperature increases they needed.",
+    "llemba_segments_total": "Scored segments by method and status.",
+    "llemba_hedges_total": "Duplicates sent for slow API calls, by which of the two calls answered first.",
+    "llemba_packed_segments_total": "Segments of packed requests, answered in the packed request or by a single fallback request.",
+}
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # the last count is for values above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the quantile, None if it is above the largest bucket
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+
+class Metrics:
+    # Counters and histograms with labels, cheap enough to update on every request. They are exported as a JSON summary
+    # or as a Prometheus textfile (for the node_exporter textfile collector).
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def summary(self):
+        summary = {}
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                summary.setdefault(name, []).append({"labels": dict(labels), "value": value})
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                summary.setdefault(name, []).append({
+                    "labels": dict(labels),
+                    "count": histogram.count,
+                    "sum": histogram.sum,
+                    "mean": histogram.sum / histogram.count if histogram.count else None,
+                    "p50": histogram.quantile(0.5),
+                    "p90": histogram.quantile(0.9),
+                    "p99": histogram.quantile(0.99),
+                    "buckets": dict(zip([str(b) for b in histogram.buckets] + ["+Inf"], histogram.counts)),
+                })
+        return summary
+
+    def prometheus(self):
+        lines = []
+        described = set()
+
+        def describe(name, kind):
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                describe(name, "counter")
+                lines.append(f"{name}{format_labels(labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                describe(name, "histogram")
+                cumulative = 0
+                for bound, count in zip([str(b) for b in histogram.buckets] + ["+Inf"], histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+    def write_json(self, path):
+        write_atomic(path, json.dumps(self.summary(), indent=2))
+
+    def write_prometheus(self, path):
+        write_atomic(path, self.prometheus())
+
+
+# the HTTP status if there is one, the exception type otherwise
+def error_class(error):
+    status = error_status_code(error)
+    return str(status) if status is not None else type(error).__name__
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+
+# the textfile collector may read the file at any time, so it is replaced in one step
+def write_atomic(path, text):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(temporary, path)
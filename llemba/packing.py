@@ -0,0 +1,41 @@
+import re
+
+from llemba.cache import request_key
+from llemba.llemba_mqm_utils import compile_fields
+
+# Packed prompts score several numbered segments under one shared instruction, the answer has a "<number>: <answer>"
+# line per segment. Every segment's answer is cached on its own, under the key of its single prompt marked as packed,
+# so packed runs with different groupings share answers but do not mix with answers to single prompts.
+
+PACKED_LINE = re.compile(r'^[\s*#]*(\d+)[*]*\s*(?::|\)|\.(?=\s))\s*(.+?)\s*$', re.M)
+
+
+class PackedTemplate:
+    def __init__(self, packed, source_lang, target_lang):
+        languages = {'source_lang': source_lang, 'target_lang': target_lang}
+        self.text = compile_fields(packed["prompt"], languages)[0]
+        self.segment = compile_fields(packed["segment"], languages)[0]
+
+    def render(self, pairs):
+        segments = '\n\n'.join(self.segment.format(index=index, source_seg=source_seg, target_seg=target_seg) for index, (source_seg, target_seg) in enumerate(pairs, 1))
+        return self.text.format(segments=segments)
+
+
+def compile_packed_template(packed, source_lang, target_lang):
+    return PackedTemplate(packed, source_lang, target_lang)
+
+
+# the answer line of every segment, None for segments without exactly one line
+def split_packed_answer(text, count):
+    items = {}
+    duplicates = set()
+    for match in PACKED_LINE.finditer(text):
+        index = int(match.group(1))
+        if index in items:
+            duplicates.add(index)
+        items[index] = match.group(2)
+    return [items.get(index) if index not in duplicates else None for index in range(1, count + 1)]
+
+
+def packed_key(parameters):
+    return request_key(dict(parameters, packed=True))
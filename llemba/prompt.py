@@ -1,6 +1,15 @@
 import re
+import sys
 from termcolor import colored
 
+# patterns are compiled once, the batch functions below parse whole columns of answers and the scalar validators used
+# by TogetherApi.request are thin wrappers around them
+OUT_OF_PATTERN = re.compile(r'(\d+)\s*(?:out of|/)\s*(\d+)')
+NUMBER_PATTERN = re.compile(r'\b\d+\b')
+# "one" ... "five" between spaces or "1 star" ... "5 star", scanned in a single pass
+STARS_PATTERN = re.compile(r'(?<= )(one|two|three|four|five)(?= )|([1-5]) star')
+STAR_WORDS = {"one": 1, "two": 2, "three": 3, "four": 4, "five": 5}
+
 
 def parse_and_check_numerical_answer(answer, min=None, max=None):
     attempt = parse_numerical_answer(answer, min, max)
@@ -13,7 +22,7 @@ def parse_and_check_numerical_answer(answer, min=None, max=None):
 
 def parse_numerical_answer(answer, min=0, max=100):
     # Pattern 1: Look for "X out of Y" or "X/Y" formats
-    match = re.search(r'(\d+)\s*(?:out of|/)\s*(\d+)', answer)
+    match = OUT_OF_PATTERN.search(answer)
     if match:
         score = int(match.group(1))
         total = int(match.group(2))
@@ -21,8 +30,7 @@ def parse_numerical_answer(answer, min=0, max=100):
             return score
 
     # Pattern 2: Look for single number between min and max (e.g., "Score: 80")
-    numbers = re.findall(r'\b\d+\b', answer)
-    for num in numbers:
+    for num in NUMBER_PATTERN.findall(answer):
         num = int(num)
         if min <= num <= max:
             return num
@@ -30,60 +38,72 @@ def parse_numerical_answer(answer, min=0, max=100):
     return None  # If no pattern matched, return None
 
 
+def validate_numbers(answers, min=0, max=100):
+    return [parse_and_check_numerical_answer(x, min, max) for x in answers]
+
 
 def validate_number(x, min=0, max=100):
-    attempt = parse_and_check_numerical_answer(x, min, max)
-    if attempt is not None:
-        return attempt
-    return None
+    return validate_numbers([x], min, max)[0]
 
 
-def parse_classes(answer, classes):
-    final_class = None
-    for i in range(len(classes)):
-        if classes[i].lower() in answer.lower():
-            if final_class is None:
-                final_class = i
-            else:
-                print(colored(f"Two classes found in answer {answer}", "red"))
-                return None
+def find_classes(answers, classes):
+    lowered_classes = [c.lower() for c in classes]
+    results = []
+    for answer in answers:
+        lowered = answer.lower()
+        found = [i for i, c in enumerate(lowered_classes) if c in lowered]
+        if len(found) > 1:
+            print(colored(f"Two classes found in answer {answer}", "red"), file=sys.stderr)
+            results.append(None)
+        else:
+            results.append(found[0] if found else None)
+    return results
 
-    return final_class
 
+def parse_classes(answer, classes):
+    return find_classes([answer], classes)[0]
 
-def validate_stars(x):
+
+def stars_candidates(x):
     x = x.lower()
     # try to find all possible answers as sometimes it seems to be explaining itself
     possible_answers = set()
 
     # check if string x contains * characters
-    if "*" in x:
-        possible_answers.add(x.count("*"))
-    if "★" in x:
-        possible_answers.add(x.count("★"))
+    count = x.count("*")
+    if count:
+        possible_answers.add(count)
+    count = x.count("★")
+    if count:
+        possible_answers.add(count)
 
     x = f" {x} ".replace("\n", " ")
     # possible answers: "five stars", "5 stars", "five", "five starts: perfect translation", ...
-    if " one " in x or "1 star" in x:
-        possible_answers.add(1)
-    if " two " in x or "2 star" in x:
-        possible_answers.add(2)
-    if " three " in x or "3 star" in x:
-        possible_answers.add(3)
-    if " four " in x or "4 star" in x:
-        possible_answers.add(4)
-    if " five " in x or "5 star" in x:
-        possible_answers.add(5)
+    for word, digit in STARS_PATTERN.findall(x):
+        possible_answers.add(STAR_WORDS[word] if word else int(digit))
 
     numerical = parse_numerical_answer(x)
     if numerical is not None:
         possible_answers.add(numerical)
 
-    if len(possible_answers) == 1:
-        answer = possible_answers.pop()
-        if 1 <= answer <= 5:
-            return answer
-    return None
+    return possible_answers
+
+
+def validate_stars_batch(answers):
+    results = []
+    for x in answers:
+        possible_answers = stars_candidates(x)
+        if len(possible_answers) == 1:
+            answer = possible_answers.pop()
+            if 1 <= answer <= 5:
+                results.append(answer)
+                continue
+        results.append(None)
+    return results
+
+
+def validate_stars(x):
+    return validate_stars_batch([x])[0]
 
 
 language_codes = {
@@ -93,46 +113,96 @@ language_codes = {
     "ru": "Russian",
 }
 
+# valid first tokens of expected-score answers and their scores, numbers up to 999 are one token for current tokenizers
+SCORE_TOKENS = {str(score): score for score in range(101)}
+STAR_TOKENS = {str(stars): stars for stars in range(1, 6)}
+# classes are answered by their number, the score is the class index like the one of find_classes
+CLASS_TOKENS = {str(index + 1): index for index in range(5)}
+
+# validate_answers parses a whole list of raw answers at once, e.g. to re-parse cached completions after a parser fix
+# max_tokens is the budget of one request, answers that are cut off are continued; stop ends the answer after the score
+# packed, where present, is the prompt for several numbered segments at once and the template of one segment in it
+# expected, where present, configures the expected-score mode: the valid first tokens of the answer (values) and, for
+# methods whose answer does not start with the score, a prompt asking for the score alone
 prompts = {
     "LLEMBA-DA": {
         "prompt": 'Score the following translation from {source_lang} to {target_lang} on a continuous scale from 0 to 100, where a score of zero means "no meaning preserved" and score of one hundred means "perfect meaning and grammar".\n\n{source_lang} source: "{source_seg}"\n{target_lang} translation: "{target_seg}"\nScore: ',
         "validate_answer": lambda x: validate_number(x),
-        "use_ref": False},
+        "validate_answers": lambda xs: validate_numbers(xs),
+        "use_ref": False,
+        "max_tokens": 32,
+        "stop": ["\n\n"],
+        "packed": {
+            "prompt": 'Score each of the following translations from {source_lang} to {target_lang} on a continuous scale from 0 to 100, where a score of zero means "no meaning preserved" and score of one hundred means "perfect meaning and grammar".\n\n{segments}\n\nAnswer with one line per translation in the form "<number>: <score>" and nothing else.\n',
+            "segment": '{index}. {source_lang} source: "{source_seg}"\n{index}. {target_lang} translation: "{target_seg}"'},
+        "expected": {"values": SCORE_TOKENS}},
 
     "LLEMBA-DA_ref": {
         "prompt": 'Score the following translation from {source_lang} to {target_lang} with respect to human reference on a continuous scale 0 to 100 where score of zero means "no meaning preserved" and score of one hundred means "perfect meaning and grammar".\n\n{source_lang} source: "{source_seg}"\n{target_lang} human reference: {reference_seg}\n{target_lang} machine translation: "{target_seg}"\nScore: ',
         "validate_answer": lambda x: validate_number(x),
-        "use_ref": True},
+        "validate_answers": lambda xs: validate_numbers(xs),
+        "use_ref": True,
+        "max_tokens": 32,
+        "stop": ["\n\n"]},
 
     "LLEMBA-SQM": {
         "prompt": 'Score the following translation from {source_lang} to {target_lang} on a continuous scale from 0 to 100 that starts on "No meaning preserved", goes through "Some meaning preserved", then "Most meaning preserved and few grammar mistakes", up to "Perfect meaning and grammar".\n\n{source_lang} source: "{source_seg}"\n{target_lang} translation: "{target_seg}"\nScore (0-100): ',
         "validate_answer": lambda x: validate_number(x),
-        "use_ref": False},
+        "validate_answers": lambda xs: validate_numbers(xs),
+        "use_ref": False,
+        "max_tokens": 32,
+        "stop": ["\n\n"],
+        "packed": {
+            "prompt": 'Score each of the following translations from {source_lang} to {target_lang} on a continuous scale from 0 to 100 that starts on "No meaning preserved", goes through "Some meaning preserved", then "Most meaning preserved and few grammar mistakes", up to "Perfect meaning and grammar".\n\n{segments}\n\nAnswer with one line per translation in the form "<number>: <score (0-100)>" and nothing else.\n',
+            "segment": '{index}. {source_lang} source: "{source_seg}"\n{index}. {target_lang} translation: "{target_seg}"'},
+        "expected": {"values": SCORE_TOKENS}},
 
     "LLEMBA-SQM_ref": {
         "prompt": 'Score the following machine translation from {source_lang} to {target_lang} with respect to the human reference on a continuous scale from 0 to 100 that starts with "No meaning preserved", goes through "Some meaning preserved", then "Most meaning preserved and few grammar mistakes", up to "Perfect meaning and grammar".\n\n{source_lang} source: "{source_seg}"\n{target_lang} human reference: "{reference_seg}"\n{target_lang} machine translation: "{target_seg}"\nScore (0-100): ',
         "validate_answer": lambda x: validate_number(x),
-        "use_ref": True},
+        "validate_answers": lambda xs: validate_numbers(xs),
+        "use_ref": True,
+        "max_tokens": 32,
+        "stop": ["\n\n"]},
 
     "LLEMBA-stars": {
         "prompt": 'Score the following translation from {source_lang} to {target_lang} with one to five stars. Where one star means "Nonsense/No meaning preserved", two stars mean "Some meaning preserved, but not understandable", three stars mean "Some meaning preserved and understandable", four stars mean "Most meaning preserved with possibly few grammar mistakes", and five stars mean "Perfect meaning and grammar".\n\n{source_lang} source: "{source_seg}"\n{target_lang} translation: "{target_seg}"\nStars: ',
         "validate_answer": lambda x: validate_stars(x),
-        "use_ref": False},
+        "validate_answers": lambda xs: validate_stars_batch(xs),
+        "use_ref": False,
+        "max_tokens": 32,
+        "stop": ["\n\n"],
+        "packed": {
+            "prompt": 'Score each of the following translations from {source_lang} to {target_lang} with one to five stars. Where one star means "Nonsense/No meaning preserved", two stars mean "Some meaning preserved, but not understandable", three stars mean "Some meaning preserved and understandable", four stars mean "Most meaning preserved with possibly few grammar mistakes", and five stars mean "Perfect meaning and grammar".\n\n{segments}\n\nAnswer with one line per translation in the form "<number>: <stars>" and nothing else.\n',
+            "segment": '{index}. {source_lang} source: "{source_seg}"\n{index}. {target_lang} translation: "{target_seg}"'},
+        "expected": {
+            "prompt": 'Score the following translation from {source_lang} to {target_lang} with one to five stars. Where one star means "Nonsense/No meaning preserved", two stars mean "Some meaning preserved, but not understandable", three stars mean "Some meaning preserved and understandable", four stars mean "Most meaning preserved with possibly few grammar mistakes", and five stars mean "Perfect meaning and grammar".\n\n{source_lang} source: "{source_seg}"\n{target_lang} translation: "{target_seg}"\nAnswer with the number of stars (1-5) only.\nStars: ',
+            "values": STAR_TOKENS}},
 
     "LLEMBA-stars_ref": {
         "prompt": 'Score the following translation from {source_lang} to {target_lang} with respect to the human reference with one to five stars. Where one star means "Nonsense/No meaning preserved", two stars mean "Some meaning preserved, but not understandable", three stars mean "Some meaning preserved and understandable", four stars mean "Most meaning preserved with possibly few grammar mistakes", and five stars mean "Perfect meaning and grammar".\n\n{source_lang} source: "{source_seg}"\n{target_lang} human reference: "{reference_seg}"\n{target_lang} translation: "{target_seg}"\nStars: ',
         "validate_answer": lambda x: validate_stars(x),
-        "use_ref": True},
+        "validate_answers": lambda xs: validate_stars_batch(xs),
+        "use_ref": True,
+        "max_tokens": 32,
+        "stop": ["\n\n"]},
 
     "LLEMBA-classes": {
         "prompt": 'Classify the quality of machine translation from {source_lang} to {target_lang} into one of following classes: "No meaning preserved", "Some meaning preserved, but not understandable", "Some meaning preserved and understandable", "Most meaning preserved, minor issues", "Perfect translation".\n\n{source_lang} source: "{source_seg}"\n{target_lang} machine translation: "{target_seg}"\nClass: ',
         "use_ref": False,
         "validate_answer": lambda x, classes=["No meaning preserved", "Some meaning preserved, but not understandable", "Some meaning preserved and understandable", "Most meaning preserved, minor issues", "Perfect translation"]: parse_classes(x, classes),
-        "max_tokens": 100},
+        "validate_answers": lambda xs, classes=["No meaning preserved", "Some meaning preserved, but not understandable", "Some meaning preserved and understandable", "Most meaning preserved, minor issues", "Perfect translation"]: find_classes(xs, classes),
+        "max_tokens": 48,
+        "stop": ["\n\n"],
+        "expected": {
+            "prompt": 'Classify the quality of machine translation from {source_lang} to {target_lang} into one of following classes: 1. "No meaning preserved", 2. "Some meaning preserved, but not understandable", 3. "Some meaning preserved and understandable", 4. "Most meaning preserved, minor issues", 5. "Perfect translation".\n\n{source_lang} source: "{source_seg}"\n{target_lang} machine translation: "{target_seg}"\nAnswer with the number of the class (1-5) only.\nClass: ',
+            "values": CLASS_TOKENS}},
 
     "LLEMBA-classes_ref": {
         "prompt": 'Classify the quality of machine translation from {source_lang} to {target_lang} with respect to the human reference into one of following classes: "No meaning preserved", "Some meaning preserved, but not understandable", "Some meaning preserved and understandable", "Most meaning preserved, minor issues", "Perfect translation".\n\n{source_lang} source: "{source_seg}"\n{target_lang} human reference: "{reference_seg}"\n{target_lang} machine translation: "{target_seg}"\nClass: ',
         "use_ref": True,
         "validate_answer": lambda x, classes=["No meaning preserved", "Some meaning preserved, but not understandable", "Some meaning preserved and understandable", "Most meaning preserved, minor issues", "Perfect translation"]: parse_classes(x, classes),
-        "max_tokens": 100},
+        "validate_answers": lambda xs, classes=["No meaning preserved", "Some meaning preserved, but not understandable", "Some meaning preserved and understandable", "Most meaning preserved, minor issues", "Perfect translation"]: find_classes(xs, classes),
+        "max_tokens": 48,
+        "stop": ["\n\n"]},
 }
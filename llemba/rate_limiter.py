@@ -0,0 +1,124 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+# HTTP statuses worth retrying, everything else coming back from the API (bad request, auth, unknown model) is fatal
+RETRYABLE_STATUS_CODES = {408, 409, 425, 429, 500, 502, 503, 504, 520, 522, 524}
+
+
+class TokenBucket:
+    # Reservation based token bucket: the level may go negative, which queues later callers behind earlier ones
+    def __init__(self, per_minute, burst_seconds=1.0):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, amount, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        self.level -= amount
+        if self.level >= 0:
+            return 0.0
+        return -self.level / self.rate
+
+    def refund(self, amount):
+        self.level = min(self.capacity, self.level + amount)
+
+
+class RateLimiter:
+    # Budgets requests/min and tokens/min per model, shared by every worker of a run (sync or async)
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, burst_seconds=1.0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.burst_seconds = burst_seconds
+        self.request_buckets = {}
+        self.token_buckets = {}
+        self.paused_until = {}
+        self.lock = threading.Lock()
+
+    def reserve(self, model, tokens=0):
+        # returns the number of seconds the caller has to wait before sending the request
+        with self.lock:
+            now = time.monotonic()
+            wait = max(0.0, self.paused_until.get(model, 0.0) - now)
+            if self.requests_per_minute:
+                if model not in self.request_buckets:
+                    self.request_buckets[model] = TokenBucket(self.requests_per_minute, self.burst_seconds)
+                wait = max(wait, self.request_buckets[model].reserve(1, now))
+            if self.tokens_per_minute and tokens:
+                if model not in self.token_buckets:
+                    self.token_buckets[model] = TokenBucket(self.tokens_per_minute, self.burst_seconds)
+                wait = max(wait, self.token_buckets[model].reserve(tokens, now))
+            return wait
+
+    def settle(self, model, estimated_tokens, used_tokens):
+        # correct the token budget once the real usage is known
+        if not self.tokens_per_minute or used_tokens is None:
+            return
+        with self.lock:
+            if model in self.token_buckets:
+                self.token_buckets[model].refund(estimated_tokens - used_tokens)
+
+    def pause(self, model, seconds):
+        # a 429 means the quota is already exhausted, so every worker of the model backs off, not only the one that got it
+        with self.lock:
+            self.paused_until[model] = max(self.paused_until.get(model, 0.0), time.monotonic() + seconds)
+
+
+def estimate_tokens(prompt, max_tokens=None):
+    # rough estimate of four characters per token, good enough to keep under the tokens/min budget
+    if isinstance(prompt, list):
+        chars = sum(len(p["content"]) for p in prompt)
+    else:
+        chars = len(prompt)
+    return chars // 4 + 1 + (max_tokens or 0)
+
+
+def error_status_code(error):
+    status = getattr(error, "status_code", None) or getattr(error, "http_status", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status
+
+
+def is_retryable(error):
+    status = error_status_code(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS_CODES
+    # no HTTP status means the request did not get a response: timeouts and dropped connections are retryable
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    name = type(error).__name__.lower()
+    return "timeout" in name or "connection" in name
+
+
+def retry_after_seconds(error):
+    headers = getattr(getattr(error, "response", None), "headers", None) or getattr(error, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return float(value) / 1000.0
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, retry_after=None, base=1.0, cap=60.0):
+    # exponential backoff with full jitter, the server's Retry-After wins when it is given (jittered so workers do not wake up together)
+    if retry_after is not None:
+        return min(retry_after + random.uniform(0, base), cap)
+    return random.uniform(0, min(cap, base * 2 ** attempt))
@@ -0,0 +1,55 @@
+from llemba.together_api import TEMPERATURE_STEP
+
+# status of a (segment, method) result
+PENDING = 0
+SCORED = 1
+NO_ANSWER = 2  # no valid answer even at the highest temperature
+CACHE_MISS = 3  # not in the cache in a replay run
+
+
+class ResultStore:
+    # Results of a run in preallocated typed arrays indexed by segment position and method. Only the numbers are kept,
+    # not the prompts or the raw answers, so memory grows with the number of segments and not with the prompt size.
+    def __init__(self, size, num_methods=1):
+        import numpy as np
+
+        shape = (size, num_methods)
+        self.score = np.full(shape, np.nan, dtype=np.float64)
+        # whether the method gave the score as an int, so that scores() returns it as one
+        self.integer = np.zeros(shape, dtype=np.bool_)
+        self.status = np.full(shape, PENDING, dtype=np.int8)
+        self.temperature = np.full(shape, np.nan, dtype=np.float32)
+        self.attempts = np.zeros(shape, dtype=np.int16)
+        # completion tokens of the answer, -1 if unknown
+        self.tokens = np.full(shape, -1, dtype=np.int32)
+
+    def __len__(self):
+        return self.score.shape[0]
+
+    # answers is the list of best answers of one segment, one per method, None where no answer was valid
+    def record(self, index, answers):
+        for method, answer in enumerate(answers):
+            if answer is None:
+                self.status[index, method] = NO_ANSWER
+                self.attempts[index, method] = round(1.0 / TEMPERATURE_STEP) + 1
+                continue
+            if answer.get("cache_miss"):
+                self.status[index, method] = CACHE_MISS
+                continue
+            # the API can also return no choices at all, which gives an answer of None
+            if answer["answer"] is None:
+                self.status[index, method] = NO_ANSWER
+            else:
+                self.status[index, method] = SCORED
+                self.score[index, method] = answer["answer"]
+                self.integer[index, method] = isinstance(answer["answer"], int)
+            self.temperature[index, method] = answer["temperature"]
+            # one request per temperature that was tried
+            self.attempts[index, method] = round(answer["temperature"] / TEMPERATURE_STEP) + 1
+            if answer.get("completion_tokens") is not None:
+                self.tokens[index, method] = answer["completion_tokens"]
+
+    # scores of one method as a list of the types the method gave them in, None where there is no score
+    def scores(self, method=0):
+        return [(int(score) if integer else score) if status == SCORED else None
+                for score, integer, status in zip(self.score[:, method].tolist(), self.integer[:, method].tolist(), self.status[:, method].tolist())]
@@ -0,0 +1,199 @@
+import sys
+import math
+import random
+import itertools
+from array import array
+from absl import app, flags
+
+from llemba.utils import iter_llemba_answers
+
+# Adaptive corpus-level scoring. Segments are scored in a random order stratified over the corpus, so that every
+# prefix of the order covers all of it, and a running mean with a Student t confidence interval is kept per system.
+# Scoring stops once the interval is narrower than the tolerance or, with several systems, once every two neighbours
+# of the current ranking differ significantly (or their difference is known to within the tolerance). All systems are
+# scored on the same segments and compared on their paired differences, which vary much less than the scores.
+
+
+class RunningMean:
+    # Welford's online mean and variance
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def half_width(self, confidence):
+        # half width of the confidence interval of the mean, infinite until there are two values
+        if self.count < 2:
+            return math.inf
+        from scipy.stats import t
+
+        return float(t.ppf(0.5 + confidence / 2, self.count - 1)) * math.sqrt(self.m2 / (self.count - 1) / self.count)
+
+
+# a random permutation of range(size) taking one segment of each of `strata` contiguous blocks in turn, the same for a
+# given seed so that a rerun with a tighter tolerance continues from the cache
+def stratified_order(size, strata=16, seed=0):
+    rng = random.Random(seed)
+    strata = max(1, min(strata, size))
+    bounds = [size * i // strata for i in range(strata + 1)]
+    blocks = []
+    for start, end in zip(bounds, bounds[1:]):
+        block = list(range(start, end))
+        rng.shuffle(block)
+        blocks.append(block)
+    return [index for rank in itertools.zip_longest(*blocks) for index in rank if index is not None]
+
+
+def line_offsets(path):
+    offsets = array('q')
+    offset = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            offsets.append(offset)
+            offset += len(line)
+    return offsets
+
+
+class LineFile:
+    # random access to the stripped lines of a file through their offsets, without holding the lines in memory
+    def __init__(self, path):
+        self.path = path
+        self.offsets = line_offsets(path)
+        self.file = open(path, 'rb')
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        self.file.seek(self.offsets[index])
+        return self.file.readline().decode('utf-8').strip()
+
+    def close(self):
+        self.file.close()
+
+
+def converged(means, differences, tolerance, confidence):
+    if len(means) == 1:
+        return means[0].half_width(confidence) <= tolerance
+    ranking = sorted(range(len(means)), key=lambda system: -means[system].mean)
+    # neighbours of the current ranking, Bonferroni-corrected over the comparisons
+    pair_confidence = 1 - (1 - confidence) / (len(means) - 1)
+    for a, b in zip(ranking, ranking[1:]):
+        difference = differences[min(a, b), max(a, b)]
+        half_width = difference.half_width(pair_confidence)
+        if abs(difference.mean) <= half_width and half_width > tolerance:
+            return False
+    return True
+
+
+# source and every hypothesis are sequences of segments of the same length (lists or LineFile). Returns the mean score
+# and the half width of its confidence interval for every system, the ranking (best first), how many segments were
+# requested and used, and whether the stopping rule was met before the corpus ran out.
+def sample_corpus_scores(source, hypotheses, source_lang, target_lang, method, model, tolerance=None, confidence=0.95, min_segments=30, strata=16, seed=0,
+                         concurrency=1, togetherapi=None, cache=None, window=None):
+    assert all(len(hypothesis) == len(source) for hypothesis in hypotheses), "Source and hypotheses must have the same number of segments."
+    # systems with (nearly) the same scores never differ significantly, so several systems need a tolerance as well
+    assert tolerance is not None, "A tolerance must be provided to stop at."
+    systems = len(hypotheses)
+    order = stratified_order(len(source), strata, seed)
+    means = [RunningMean() for _ in hypotheses]
+    differences = {pair: RunningMean() for pair in itertools.combinations(range(systems), 2)}
+
+    # the segments of all systems are interleaved, so that the answers of one segment arrive together
+    pairs = ((source[index], hypothesis[index]) for index in order for hypothesis in hypotheses)
+    answers = iter_llemba_answers(pairs, source_lang, target_lang, method, model, concurrency=concurrency, togetherapi=togetherapi, cache=cache, window=window, total=len(order) * systems)
+    requested = 0
+    stopped = False
+    try:
+        for _ in order:
+            scores = [answer["answer"] if answer is not None else None for answer in itertools.islice(answers, systems)]
+            requested += 1
+            # a segment is only used if every system has a score for it
+            if None in scores:
+                continue
+            for mean, score in zip(means, scores):
+                mean.add(score)
+            for (a, b), difference in differences.items():
+                difference.add(scores[a] - scores[b])
+            if means[0].count >= min_segments and converged(means, differences, tolerance, confidence):
+                stopped = True
+                break
+    finally:
+        # requests read ahead of the stopping point are cancelled
+        answers.close()
+
+    return {
+        "means": [mean.mean if mean.count > 0 else None for mean in means],
+        "half_widths": [mean.half_width(confidence) for mean in means],
+        "ranking": sorted(range(systems), key=lambda system: -means[system].mean),
+        "requested": requested,
+        "used": means[0].count,
+        "total": len(source),
+        "converged": stopped,
+    }
+
+
+def main(argv):
+    from llemba.cache import ResponseCache
+    from llemba.backends import make_backend
+    from llemba.rate_limiter import RateLimiter
+    from llemba.together_api import TogetherApi
+
+    FLAGS = flags.FLAGS
+    assert FLAGS.source is not None and FLAGS.hypotheses, "Source and hypothesis files must be provided."
+    assert FLAGS.source_lang is not None and FLAGS.target_lang is not None, "Source and target language names must be provided."
+    rate_limiter = RateLimiter(requests_per_minute=FLAGS.requests_per_minute, tokens_per_minute=FLAGS.tokens_per_minute)
+    if FLAGS.backend == 'fake':
+        backend = make_backend('fake', latency_ms=FLAGS.fake_latency_ms)
+    else:
+        backend = make_backend(FLAGS.backend, base_url=FLAGS.base_url)
+    togetherapi = TogetherApi(rate_limiter=rate_limiter, max_attempts=FLAGS.max_attempts, backend=backend)
+    cache = ResponseCache(FLAGS.cache_dir, size_limit=FLAGS.cache_size_gb * 2 ** 30)
+
+    source = LineFile(FLAGS.source)
+    hypotheses = [LineFile(path) for path in FLAGS.hypotheses]
+    try:
+        result = sample_corpus_scores(source, hypotheses, FLAGS.source_lang, FLAGS.target_lang, FLAGS.method, FLAGS.model, tolerance=FLAGS.tolerance, confidence=FLAGS.confidence,
+                                      min_segments=FLAGS.min_segments, seed=FLAGS.seed, concurrency=FLAGS.concurrency, togetherapi=togetherapi, cache=cache)
+    finally:
+        for f in [source] + hypotheses:
+            f.close()
+        cache.close()
+
+    # one line per system, best first: rank, mean, half width of the interval and file
+    for rank, system in enumerate(result["ranking"], 1):
+        print(f"{rank}\t{result['means'][system]}\t{result['half_widths'][system]}\t{FLAGS.hypotheses[system]}")
+    state = "converged" if result["converged"] else "did not converge"
+    print(f"Scored {result['requested']} of {result['total']} segments per system ({result['requested'] / max(result['total'], 1):.1%}), {state}.", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    from llemba.backends import BACKENDS
+    from llemba.cache import DEFAULT_CACHE_DIR
+
+    flags.DEFINE_string('source', None, 'Filepath to the source file.')
+    flags.DEFINE_list('hypotheses', None, 'Comma-separated translation files of the systems to score, line by line parallel to the source.')
+    flags.DEFINE_string('source_lang', None, 'Source language name.')
+    flags.DEFINE_string('target_lang', None, 'Target language name.')
+    flags.DEFINE_string('method', 'LLEMBA-DA', 'Which method to use?')
+    flags.DEFINE_string('model', None, 'Select Model')
+    flags.DEFINE_float('tolerance', None, 'Required. Stop once the confidence interval of the mean (or of the difference of two neighbouring systems) is narrower than this, in score points on either side.')
+    flags.DEFINE_float('confidence', 0.95, 'Confidence level of the intervals.')
+    flags.DEFINE_integer('min_segments', 30, 'Segments scored before the stopping rule is checked.')
+    flags.DEFINE_integer('seed', 0, 'Seed of the sampling order, runs with the same seed reuse the cached answers.')
+    flags.DEFINE_enum('backend', 'together', BACKENDS, 'API to send requests to, as in main.py.')
+    flags.DEFINE_string('base_url', None, 'Base url of the OpenAI-compatible server.')
+    flags.DEFINE_float('fake_latency_ms', 0.0, 'Median latency of the fake backend in milliseconds.')
+    flags.DEFINE_integer('concurrency', 1, 'Maximum number of API requests in flight at once.')
+    flags.DEFINE_integer('requests_per_minute', None, 'Request budget per minute for the model, unlimited if not set.')
+    flags.DEFINE_integer('tokens_per_minute', None, 'Token budget (prompt + completion) per minute for the model, unlimited if not set.')
+    flags.DEFINE_integer('max_attempts', 8, 'How many times a failing API request is tried before giving up.')
+    flags.DEFINE_string('cache_dir', DEFAULT_CACHE_DIR, 'Directory of the response cache.')
+    flags.DEFINE_float('cache_size_gb', 10, 'Size limit of the response cache in GiB.')
+    app.run(main)
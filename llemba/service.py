@@ -0,0 +1,216 @@
+import os
+import sys
+import json
+import stat
+import socket
+import asyncio
+import threading
+import http.client
+from http.server import BaseHTTPRequestHandler
+from socketserver import ThreadingUnixStreamServer
+from absl import app, flags
+
+from llemba.utils import answer_status, get_method
+from llemba.llemba_mqm_utils import compile_template
+
+# A long-running scoring service on a Unix socket. It keeps one TogetherApi (client, connection pool, rate limiter,
+# token budgets), one response cache and one event loop warm for all callers. Requests of concurrent callers are
+# dispatched on that loop under one concurrency limit, and identical requests share a single API call, so a small
+# batch costs about one model latency instead of a client setup, a cache open and a TLS handshake.
+#
+#   POST /score    {"source": [...], "hypothesis": [...], "source_lang": ..., "target_lang": ..., "methods": [...], "model": ...}
+#                  -> {"scores": [[score per method] per segment], "status": [[...]]}
+#   GET  /metrics  Prometheus text of the service metrics
+#   GET  /health   {"ok": true}
+
+
+class ScoringService:
+    def __init__(self, togetherapi, cache, concurrency=64):
+        self.togetherapi = togetherapi
+        self.cache = cache
+        self.concurrency = concurrency
+        self.templates = {}
+        self.loop = asyncio.new_event_loop()
+        self.semaphore = None
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def template(self, method, template, source_lang, target_lang):
+        key = (method, source_lang, target_lang)
+        if key not in self.templates:
+            self.templates[key] = compile_template(template, source_lang, target_lang)
+        return self.templates[key]
+
+    async def ascore(self, source, hypothesis, source_lang, target_lang, methods, model):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        configs = [get_method(method) for method in methods]
+
+        async def run(prompt, parse_answer, max_tokens, stop):
+            async with self.semaphore:
+                answers = await self.togetherapi.arequest(prompt, model, parse_answer, cache=self.cache, max_tokens=max_tokens, stop=stop)
+            return answers[0] if len(answers) > 0 else None
+
+        tasks = []
+        for method, (template, parse_answer, max_tokens, stop) in zip(methods, configs):
+            prompts = self.template(method, template, source_lang, target_lang).render_many(source, hypothesis)
+            tasks.append([asyncio.ensure_future(run(prompt, parse_answer, max_tokens, stop)) for prompt in prompts])
+        try:
+            best = [await asyncio.gather(*method_tasks) for method_tasks in tasks]
+        finally:
+            for task in (task for method_tasks in tasks for task in method_tasks):
+                task.cancel()
+        # one row per segment with a column per method, like the output of main.py
+        return {
+            "scores": [[answer["answer"] if answer is not None else None for answer in row] for row in zip(*best)],
+            "status": [[answer_status(answer) for answer in row] for row in zip(*best)],
+        }
+
+    def score(self, source, hypothesis, source_lang, target_lang, methods, model):
+        # called from the request threads, the work runs on the service loop
+        return asyncio.run_coroutine_threadsafe(self.ascore(source, hypothesis, source_lang, target_lang, methods, model), self.loop).result()
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.togetherapi.backend.aclose(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.cache.close()
+
+
+def parse_score_request(body):
+    request = json.loads(body)
+    methods = request.get("methods") or [request.get("method")]
+    for field in ["source", "hypothesis", "source_lang", "target_lang", "model"]:
+        if request.get(field) is None:
+            raise ValueError(f"Field {field} must be provided.")
+    if None in methods:
+        raise ValueError("Field methods must be provided.")
+    if len(request["source"]) != len(request["hypothesis"]):
+        raise ValueError("Source and hypothesis must have the same number of segments.")
+    return request["source"], request["hypothesis"], request["source_lang"], request["target_lang"], methods, request["model"]
+
+
+def serve(service, path):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            if self.path == '/health':
+                return self.reply(200, {"ok": True})
+            if self.path == '/metrics':
+                return self.reply(200, service.togetherapi.metrics.prometheus(), content_type='text/plain; version=0.0.4')
+            self.reply(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path != '/score':
+                return self.reply(404, {"error": "not found"})
+            try:
+                request = parse_score_request(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            except (ValueError, TypeError, AttributeError) as e:
+                return self.reply(400, {"error": str(e)})
+            try:
+                self.reply(200, service.score(*request))
+            except Exception as e:
+                self.reply(500, {"error": f"{type(e).__name__}: {e}"})
+
+        def reply(self, status, body, content_type='application/json'):
+            data = (body if isinstance(body, str) else json.dumps(body, ensure_ascii=False)).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    # a socket left behind by a killed service is replaced, any other file is not
+    if os.path.exists(path):
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            raise FileExistsError(f"{path} exists and is not a socket.")
+        os.unlink(path)
+    server = ThreadingUnixStreamServer(path, Handler)
+    server.daemon_threads = True
+    print(f"Scoring service listening on {path}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class ServiceClient:
+    # keeps one connection to the service open, a client is meant to be used by one thread
+    def __init__(self, path, timeout=None):
+        self.connection = UnixHTTPConnection(path, timeout=timeout)
+
+    def score(self, source, hypothesis, source_lang, target_lang, methods, model):
+        body = json.dumps({"source": list(source), "hypothesis": list(hypothesis), "source_lang": source_lang, "target_lang": target_lang, "methods": list(methods), "model": model})
+        self.connection.request('POST', '/score', body=body, headers={'Content-Type': 'application/json'})
+        response = self.connection.getresponse()
+        result = json.loads(response.read())
+        if response.status != 200:
+            raise RuntimeError(f"Scoring service error {response.status}: {result.get('error')}")
+        return result
+
+    def close(self):
+        self.connection.close()
+
+
+def main(argv):
+    from llemba.cache import ResponseCache
+    from llemba.backends import make_backend
+    from llemba.metrics import Metrics
+    from llemba.rate_limiter import RateLimiter
+    from llemba.together_api import TogetherApi
+    from llemba.hedging import Hedger
+
+    FLAGS = flags.FLAGS
+    rate_limiter = RateLimiter(requests_per_minute=FLAGS.requests_per_minute, tokens_per_minute=FLAGS.tokens_per_minute)
+    if FLAGS.backend == 'fake':
+        backend = make_backend('fake', timeout=FLAGS.request_timeout, latency_ms=FLAGS.fake_latency_ms)
+    else:
+        backend = make_backend(FLAGS.backend, base_url=FLAGS.base_url, timeout=FLAGS.request_timeout)
+    metrics = Metrics()
+    hedger = Hedger(quantile=FLAGS.hedge_quantile, budget=FLAGS.hedge_budget, metrics=metrics) if FLAGS.hedge_quantile is not None else None
+    togetherapi = TogetherApi(rate_limiter=rate_limiter, max_attempts=FLAGS.max_attempts, backend=backend, on_cache_miss='gap', metrics=metrics, hedger=hedger)
+    cache = ResponseCache(FLAGS.cache_dir, size_limit=FLAGS.cache_size_gb * 2 ** 30)
+    service = ScoringService(togetherapi, cache, concurrency=FLAGS.concurrency)
+    try:
+        serve(service, FLAGS.socket)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+
+
+if __name__ == "__main__":
+    from llemba.backends import BACKENDS
+    from llemba.cache import DEFAULT_CACHE_DIR
+
+    flags.DEFINE_string('socket', 'llemba.sock', 'Path of the Unix socket to listen on.')
+    flags.DEFINE_enum('backend', 'together', BACKENDS, 'API to send requests to, as in main.py.')
+    flags.DEFINE_string('base_url', None, 'Base url of the OpenAI-compatible server.')
+    flags.DEFINE_float('fake_latency_ms', 0.0, 'Median latency of the fake backend in milliseconds.')
+    flags.DEFINE_integer('concurrency', 64, 'Maximum number of API requests in flight at once, over all callers.')
+    flags.DEFINE_integer('requests_per_minute', None, 'Request budget per minute for the model, unlimited if not set.')
+    flags.DEFINE_integer('tokens_per_minute', None, 'Token budget (prompt + completion) per minute for the model, unlimited if not set.')
+    flags.DEFINE_integer('max_attempts', 8, 'How many times a failing API request is tried before giving up.')
+    flags.DEFINE_float('request_timeout', None, 'Seconds after which a single API request fails and is retried, the client default if not set.')
+    flags.DEFINE_float('hedge_quantile', None, 'Send a duplicate of requests slower than this quantile of the recent latencies (e.g. 0.95). No hedging if not set.')
+    flags.DEFINE_float('hedge_budget', 0.05, 'Maximum share of requests that are hedged.')
+    flags.DEFINE_string('cache_dir', DEFAULT_CACHE_DIR, 'Directory of the response cache.')
+    flags.DEFINE_float('cache_size_gb', 10, 'Size limit of the response cache in GiB.')
+    app.run(main)
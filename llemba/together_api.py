@@ -1,49 +1,357 @@
-import os
 import sys
+import json
 import time
+import asyncio
 import logging
+import collections
 from termcolor import colored
 from datetime import datetime
-from together import Together
 from dotenv import load_dotenv
-import tqdm
+
+from llemba.cache import request_key
+from llemba.backends import CacheMiss, TogetherBackend
+from llemba.token_budget import TokenBudgets
+from llemba.expected import EXPECTED_TOP_LOGPROBS, expected_score, first_token_logprobs
+from llemba.metrics import Metrics, error_class
+from llemba.packing import packed_key, split_packed_answer
+from llemba.rate_limiter import RateLimiter, backoff_delay, error_status_code, estimate_tokens, is_retryable, retry_after_seconds
 
 load_dotenv()  # Load environment variables from .env
 
+# when no answer is valid, the request is repeated with the temperature raised by this step up to 1.0
+TEMPERATURE_STEP = 0.1
+
+
+# logprobs asks for the top-k logprobs of every generated token, in the Together format (an integer k)
+def build_parameters(prompt, model, temperature, max_tokens, stop=None, logprobs=None):
+    parameters = {
+        "model": model,
+        "temperature": temperature,
+        "top_p": 1.0,
+        "top_k": 50,
+        "repetition_penalty": 1.0,
+        "stop": ["<|eot_id|>", "<|eom_id|>"] + list(stop or []),
+        "stream": False,
+    }
+
+    if max_tokens is not None:
+        parameters["max_tokens"] = max_tokens
+
+    # only set when asked for, so that the cache keys of other requests stay the same
+    if logprobs is not None:
+        parameters["logprobs"] = logprobs
+
+    if isinstance(prompt, list):
+        # Check that prompt contains a list of dictionaries with role and content
+        assert all(isinstance(p, dict) for p in prompt), "Prompts must be a list of dictionaries."
+        assert all("role" in p and "content" in p for p in prompt), "Prompts must be a list of dictionaries with role and content."
+        parameters["messages"] = prompt
+    else:
+        parameters["messages"] = [{"role": "user", "content": prompt}]
+
+    return parameters
+
+
+# asks the model to carry on from an answer that was cut off, by handing the partial answer back as the assistant turn
+def continuation_prompt(prompt, partial_answer):
+    if isinstance(prompt, list):
+        messages = list(prompt)
+    else:
+        messages = [{"role": "user", "content": prompt}]
+    return messages + [{"role": "assistant", "content": partial_answer}]
+
+
 class TogetherApi:
-    def __init__(self, verbose=False):
+    # backend is any object of llemba.backends (Together by default, an OpenAI-compatible server or the fake backend)
+    # on_cache_miss is what happens when the replay backend is asked for a request that is not cached: "fail" raises
+    # CacheMiss, "gap" gives an answer of None marked with cache_miss
+    # metrics (llemba.metrics.Metrics) collects latencies, tokens, cache lookups, retries and temperature escalations
+    # hedger (llemba.hedging.Hedger) duplicates async calls that are slower than usual, no hedging if None
+    def __init__(self, verbose=False, rate_limiter=None, max_attempts=8, max_continuations=8, backend=None, on_cache_miss="fail", metrics=None, hedger=None):
+        assert on_cache_miss in ["fail", "gap"], f"Unknown cache miss policy {on_cache_miss}."
         self.verbose = verbose
-        api_key = os.getenv('TOGETHER_API_KEY')
-        if not api_key:
-            raise ValueError("API key not found. Please set the TOGETHER_API_KEY environment variable.")
-        self.client = Together(api_key=api_key)
+        self.on_cache_miss = on_cache_miss
+        self.cache_misses = 0
+        self.max_continuations = max_continuations
+        self.token_budgets = TokenBudgets()
+        # the limiter can be shared between several TogetherApi instances talking to the same account
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.max_attempts = max_attempts
+        self.backend = backend if backend is not None else TogetherBackend()
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.hedger = hedger
+        # API calls currently in flight by request key, with the number of callers waiting for each
+        self.inflight = {}
         logging.getLogger().setLevel(logging.CRITICAL)  # Suppress all HTTP INFO log messages
 
     # answer_id is used for determining if it was the top answer or how deep in the list it was
-    def request(self, prompt, model, parse_response, temperature=0.0, answer_id=-1, cache=None, max_tokens=None):
+    def request(self, prompt, model, parse_response, temperature=0.0, answer_id=-1, cache=None, max_tokens=None, stop=None):
+        if cache is None:
+            cache = {}
+        # the key is a hash of everything sent to the model, which also works for chat prompts
+        key = request_key(build_parameters(prompt, model, temperature, max_tokens, stop))
+
+        answers = cache.get(key)
+        self.metrics.inc("llemba_cache_lookups_total", model=model, result="hit" if answers else "miss")
+        if not answers:
+            try:
+                answers = self.request_api(prompt, model, temperature, max_tokens, stop)
+            except CacheMiss as e:
+                return self.cache_miss(e, model, temperature, answer_id)
+            except Exception as e:
+                return self.failed(e, model)
+            self.cache_store(cache, key, answers, model)
+
+        parsed_answers, answer_id = self.parse_answers(answers, model, parse_response, temperature, answer_id)
+
+        # There was no valid answer, increase temperature and try again
+        if len(parsed_answers) == 0:
+            if temperature >= 1.0:
+                return self.finished(model, temperature, [])
+            new_temperature = min(temperature + TEMPERATURE_STEP, 1.0)
+            return self.request(prompt, model, parse_response, temperature=new_temperature, answer_id=answer_id, cache=cache, max_tokens=max_tokens, stop=stop)
+
+        return self.finished(model, temperature, parsed_answers)
+
+    async def arequest(self, prompt, model, parse_response, temperature=0.0, answer_id=-1, cache=None, max_tokens=None, stop=None):
         if cache is None:
             cache = {}
-        request = {"model": model, "temperature": temperature, "prompt": prompt}
+        # the key is a hash of everything sent to the model, which also works for chat prompts
+        key = request_key(build_parameters(prompt, model, temperature, max_tokens, stop))
+
+        answers = cache.get(key)
+        self.metrics.inc("llemba_cache_lookups_total", model=model, result="hit" if answers else "miss")
+        if not answers:
+            try:
+                answers = await self.single_flight(key, lambda: self.arequest_api(prompt, model, temperature, max_tokens, stop))
+            except CacheMiss as e:
+                return self.cache_miss(e, model, temperature, answer_id)
+            except Exception as e:
+                return self.failed(e, model)
+            self.cache_store(cache, key, answers, model)
+
+        parsed_answers, answer_id = self.parse_answers(answers, model, parse_response, temperature, answer_id)
+
+        # There was no valid answer, increase temperature and try again
+        if len(parsed_answers) == 0:
+            if temperature >= 1.0:
+                return self.finished(model, temperature, [])
+            new_temperature = min(temperature + TEMPERATURE_STEP, 1.0)
+            return await self.arequest(prompt, model, parse_response, temperature=new_temperature, answer_id=answer_id, cache=cache, max_tokens=max_tokens, stop=stop)
+
+        return self.finished(model, temperature, parsed_answers)
+
+    # Scores the segments of prompts (their single prompts) with one request for all of them built by packed_template from
+    # pairs. Returns the parsed answers of every segment, segments whose line of the packed answer is missing or does
+    # not parse are requested on their own. Without a packed_template every segment is requested on its own.
+    def request_packed(self, prompts, pairs, packed_template, model, parse_response, cache=None, max_tokens=None, stop=None):
+        if cache is None:
+            cache = {}
+        if packed_template is not None:
+            results, keys, missing = self.packed_lookup(prompts, model, parse_response, cache, max_tokens, stop)
+            if len(missing) > 1:
+                try:
+                    answers = self.request_api(packed_template.render([pairs[i] for i in missing]), model, 0.0, max_tokens * len(missing) if max_tokens else None)
+                    self.packed_store(answers, results, keys, missing, model, parse_response, cache)
+                except Exception:
+                    # a replay has no packed answers to give and a packed request may fail where single ones do not
+                    # (e.g. over the context length), the segments are requested (or left as gaps) one by one
+                    pass
+        else:
+            results = [None] * len(prompts)
+        for i, prompt in enumerate(prompts):
+            if results[i] is None:
+                results[i] = self.request(prompt, model, parse_response, cache=cache, max_tokens=max_tokens, stop=stop)
+        return results
+
+    async def arequest_packed(self, prompts, pairs, packed_template, model, parse_response, cache=None, max_tokens=None, stop=None):
+        if cache is None:
+            cache = {}
+        if packed_template is not None:
+            results, keys, missing = self.packed_lookup(prompts, model, parse_response, cache, max_tokens, stop)
+            if len(missing) > 1:
+                try:
+                    answers = await self.arequest_api(packed_template.render([pairs[i] for i in missing]), model, 0.0, max_tokens * len(missing) if max_tokens else None)
+                    self.packed_store(answers, results, keys, missing, model, parse_response, cache)
+                except Exception:
+                    # a replay has no packed answers to give and a packed request may fail where single ones do not
+                    # (e.g. over the context length), the segments are requested (or left as gaps) one by one
+                    pass
+        else:
+            results = [None] * len(prompts)
+        single = [i for i in range(len(prompts)) if results[i] is None]
+        answers = await asyncio.gather(*(self.arequest(prompts[i], model, parse_response, cache=cache, max_tokens=max_tokens, stop=stop) for i in single))
+        for i, parsed_answers in zip(single, answers):
+            results[i] = parsed_answers
+        return results
+
+    # cached packed answers of the segments, and which segments still need one. Segments that were answered by a single
+    # request before are left to request(), which finds their answers in the cache.
+    def packed_lookup(self, prompts, model, parse_response, cache, max_tokens, stop):
+        results = [None] * len(prompts)
+        keys = [packed_key(build_parameters(prompt, model, 0.0, max_tokens, stop)) for prompt in prompts]
+        missing = []
+        for i, key in enumerate(keys):
+            if request_key(build_parameters(prompts[i], model, 0.0, max_tokens, stop)) in cache:
+                continue
+            answers = cache.get(key)
+            self.metrics.inc("llemba_cache_lookups_total", model=model, result="hit" if answers else "miss")
+            parsed_answers = self.parse_answers(answers, model, parse_response, 0.0, -1)[0] if answers else []
+            if len(parsed_answers) > 0:
+                results[i] = parsed_answers
+            else:
+                missing.append(i)
+        return results, keys, missing
+
+    # splits a packed answer into the answers of its segments and caches every one that parses
+    def packed_store(self, answers, results, keys, missing, model, parse_response, cache):
+        items = split_packed_answer(answers[0]["answer"], len(missing)) if len(answers) > 0 else [None] * len(missing)
+        for i, item in zip(missing, items):
+            if item is not None:
+                segment_answers = [{"answer": item, "finish_reason": "stop"}]
+                parsed_answers = self.parse_answers(segment_answers, model, parse_response, 0.0, -1)[0]
+                if len(parsed_answers) > 0:
+                    self.cache_store(cache, keys[i], segment_answers, model)
+                    results[i] = parsed_answers
+            self.metrics.inc("llemba_packed_segments_total", model=model, result="packed" if results[i] is not None else "fallback")
+
+    # Expected-score mode: one token at temperature 0 with its top-k logprobs, the score is the expectation over the
+    # valid score tokens in values (llemba.expected). The score cannot fail to parse, so the temperature is never raised,
+    # an answer without any valid token among the top-k has no score.
+    def request_expected(self, prompt, model, values, cache=None, top_logprobs=EXPECTED_TOP_LOGPROBS):
+        if cache is None:
+            cache = {}
+        key = request_key(build_parameters(prompt, model, 0.0, 1, logprobs=top_logprobs))
+
+        answers = cache.get(key)
+        self.metrics.inc("llemba_cache_lookups_total", model=model, result="hit" if answers else "miss")
+        if not answers:
+            try:
+                answers = self.logprob_answers(self.call_with_retries(prompt, model, 0.0, 1, logprobs=top_logprobs))
+            except CacheMiss as e:
+                return self.cache_miss(e, model, 0.0, -1)
+            except Exception as e:
+                return self.failed(e, model)
+            self.cache_store(cache, key, answers, model)
+
+        return self.finished(model, 0.0, self.expected_answers(answers, model, values))
+
+    async def arequest_expected(self, prompt, model, values, cache=None, top_logprobs=EXPECTED_TOP_LOGPROBS):
+        if cache is None:
+            cache = {}
+        key = request_key(build_parameters(prompt, model, 0.0, 1, logprobs=top_logprobs))
+
+        answers = cache.get(key)
+        self.metrics.inc("llemba_cache_lookups_total", model=model, result="hit" if answers else "miss")
+        if not answers:
+            try:
+                answers = await self.single_flight(key, lambda: self.alogprob_request(prompt, model, top_logprobs))
+            except CacheMiss as e:
+                return self.cache_miss(e, model, 0.0, -1)
+            except Exception as e:
+                return self.failed(e, model)
+            self.cache_store(cache, key, answers, model)
+
+        return self.finished(model, 0.0, self.expected_answers(answers, model, values))
+
+    async def alogprob_request(self, prompt, model, top_logprobs):
+        return self.logprob_answers(await self.acall_with_retries(prompt, model, 0.0, 1, logprobs=top_logprobs))
+
+    # the first token of every choice with its top-k logprobs, choices without logprobs are dropped
+    def logprob_answers(self, response):
+        answers = []
+        for choice in response.choices:
+            top_logprobs = first_token_logprobs(choice)
+            if top_logprobs is None:
+                continue
+            message = getattr(choice, "message", None)
+            answers.append({
+                "answer": getattr(message, "content", None) or "",
+                "finish_reason": choice.finish_reason,
+                "top_logprobs": top_logprobs,
+                "completion_tokens": self.completion_tokens(response),
+            })
+        return answers
+
+    def expected_answers(self, answers, model, values):
+        parsed_answers = []
+        for answer_id, answer in enumerate(answers):
+            score = expected_score(answer.get("top_logprobs") or {}, values)
+            if self.verbose:
+                print("Expected score: " + colored(score, "yellow") + " (" + colored(answer.get("top_logprobs"), "blue") + ")", file=sys.stderr)
+            if score is None:
+                self.metrics.inc("llemba_parse_failures_total", model=model)
+                continue
+            parsed_answers.append({
+                "temperature": 0.0,
+                "answer_id": answer_id,
+                "answer": score,
+                "finish_reason": answer["finish_reason"],
+                "model": model,
+                "completion_tokens": answer.get("completion_tokens"),
+            })
+        return parsed_answers
+
+    # identical requests in flight share one call. It runs in a task of its own, so that a caller that is cancelled (e.g.
+    # because another request of its batch failed) does not cancel it for the others, and it is only cancelled together
+    # with its last caller.
+    async def single_flight(self, key, call):
+        if key not in self.inflight:
+            task = asyncio.ensure_future(call())
+            self.inflight[key] = [task, 0]
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        flight = self.inflight[key]
+        flight[1] += 1
+        try:
+            return await asyncio.shield(flight[0])
+        except asyncio.CancelledError:
+            if flight[1] == 1:
+                flight[0].cancel()
+            raise
+        finally:
+            flight[1] -= 1
+
+    def finished(self, model, temperature, parsed_answers):
+        self.metrics.inc("llemba_escalation_depth_total", model=model, depth=round(temperature / TEMPERATURE_STEP), valid="yes" if parsed_answers else "no")
+        return parsed_answers
+
+    # a request that failed for good (an error that is not retried, or no attempts left) has no answer, so that one bad
+    # segment does not stop the whole run
+    def failed(self, error, model):
+        self.metrics.inc("llemba_failed_requests_total", model=model, error=error_class(error))
+        return []
 
-        # Convert the request dictionary to a hashable key
-        request_key = tuple(sorted(request.items()))
+    def cache_miss(self, error, model, temperature, answer_id):
+        self.cache_misses += 1
+        if self.on_cache_miss == "fail":
+            raise error
+        return [{
+            "temperature": temperature,
+            "answer_id": answer_id,
+            "answer": None,
+            "finish_reason": None,
+            "model": model,
+            "completion_tokens": None,
+            "cache_miss": True,
+        }]
 
-        if request_key in cache and cache[request_key] is not None and len(cache[request_key]) > 0:
-            answers = cache[request_key]
+    def cache_store(self, cache, key, answers, model):
+        if isinstance(cache, dict):
+            cache[key] = answers
         else:
-            answers = self.request_api(prompt, model, temperature, max_tokens)
-            cache[request_key] = answers
+            cache.set(key, answers, tag=model)
 
+    def parse_answers(self, answers, model, parse_response, temperature, answer_id):
         # There is no valid answer
         if len(answers) == 0:
             return [{
                 "temperature": temperature,
                 "answer_id": answer_id,
                 "answer": None,
-                "prompt": prompt,
                 "finish_reason": None,
                 "model": model,
-            }]
+                "completion_tokens": None,
+            }], answer_id
 
         parsed_answers = []
         for full_answer in answers:
@@ -54,110 +362,335 @@ class TogetherApi:
             if self.verbose or temperature > 0:
                 print(f"Answer (t={temperature}): " + colored(answer, "yellow") + " (" + colored(full_answer_text, "blue") + ")", file=sys.stderr)
             if answer is None:
+                self.metrics.inc("llemba_parse_failures_total", model=model)
                 continue
             parsed_answers.append(
                 {
                     "temperature": temperature,
                     "answer_id": answer_id,
                     "answer": answer,
-                    "prompt": prompt,
                     "finish_reason": finish_reason,
                     "model": model,
+                    "completion_tokens": full_answer.get("completion_tokens"),
                 }
             )
 
-        # There was no valid answer, increase temperature and try again
-        if len(parsed_answers) == 0:
-            if temperature >= 1.0:
-                return []
-            new_temperature = min(temperature + 0.1, 1.0)
-            return self.request(prompt, model, parse_response, temperature=new_temperature, answer_id=answer_id, cache=cache, max_tokens=max_tokens)
+        return parsed_answers, answer_id
 
-        return parsed_answers
+    def request_api(self, prompt, model, temperature=0.0, max_tokens=None, stop=None):
+        if temperature > 1.0:
+            return []
+
+        # the first request is sized from the completion lengths seen so far, answers that are cut off are continued
+        first_chunk = self.token_budgets.first_chunk(model, max_tokens)
+        response = self.call_with_retries(prompt, model, temperature, first_chunk, stop)
+        answers = self.parse_response(response)
+        completion_tokens = self.completion_tokens(response)
+        for answer in answers:
+            budget = first_chunk
+            for _ in range(self.max_continuations):
+                if not self.is_truncated(answer) or not (self.continues_final_message() or budget):
+                    break
+                self.metrics.inc("llemba_continuations_total", model=model)
+                if self.continues_final_message():
+                    response = self.call_with_retries(continuation_prompt(prompt, answer["answer"]), model, temperature, max_tokens, stop)
+                    self.continue_answer(answer, response)
+                    completion_tokens = self.add_tokens(completion_tokens, self.completion_tokens(response))
+                else:
+                    budget *= 2
+                    response = self.call_with_retries(prompt, model, temperature, budget, stop)
+                    self.replace_answer(answer, response)
+                    completion_tokens = self.completion_tokens(response)
+
+        if len(answers) == 1:
+            self.token_budgets.observe(model, max_tokens, completion_tokens)
+            answers[0]["completion_tokens"] = completion_tokens
+        return self.finalize_answers(answers)
 
-    def request_api(self, prompt, model, temperature=0.0, max_tokens=None):
+    async def arequest_api(self, prompt, model, temperature=0.0, max_tokens=None, stop=None):
         if temperature > 1.0:
             return []
 
+        # the first request is sized from the completion lengths seen so far, answers that are cut off are continued
+        first_chunk = self.token_budgets.first_chunk(model, max_tokens)
+        response = await self.acall_with_retries(prompt, model, temperature, first_chunk, stop)
+        answers = self.parse_response(response)
+        completion_tokens = self.completion_tokens(response)
+        for answer in answers:
+            budget = first_chunk
+            for _ in range(self.max_continuations):
+                if not self.is_truncated(answer) or not (self.continues_final_message() or budget):
+                    break
+                self.metrics.inc("llemba_continuations_total", model=model)
+                if self.continues_final_message():
+                    response = await self.acall_with_retries(continuation_prompt(prompt, answer["answer"]), model, temperature, max_tokens, stop)
+                    self.continue_answer(answer, response)
+                    completion_tokens = self.add_tokens(completion_tokens, self.completion_tokens(response))
+                else:
+                    budget *= 2
+                    response = await self.acall_with_retries(prompt, model, temperature, budget, stop)
+                    self.replace_answer(answer, response)
+                    completion_tokens = self.completion_tokens(response)
+
+        if len(answers) == 1:
+            self.token_budgets.observe(model, max_tokens, completion_tokens)
+            answers[0]["completion_tokens"] = completion_tokens
+        return self.finalize_answers(answers)
+
+    def call_with_retries(self, prompt, model, temperature, max_tokens, stop=None, logprobs=None):
+        estimated_tokens = estimate_tokens(prompt, max_tokens)
+        attempt = 0
+        while True:
+            time.sleep(self.rate_limiter.reserve(model, estimated_tokens))
+            start = time.perf_counter()
+            try:
+                response = self.call_api(prompt, model, temperature, max_tokens, stop, logprobs)
+                self.record_call(model, start, response=response)
+                break
+            except Exception as e:
+                self.record_call(model, start, error=e)
+                attempt += 1
+                time.sleep(self.retry_delay(e, model, attempt))
+        self.rate_limiter.settle(model, estimated_tokens, self.used_tokens(response))
+        return response
+
+    async def acall_with_retries(self, prompt, model, temperature, max_tokens, stop=None, logprobs=None):
+        estimated_tokens = estimate_tokens(prompt, max_tokens)
+        attempt = 0
+        # each attempt is hedged as a whole, so that the duplicate is rate limited and recorded like any other call
+        attempt_call = lambda: self.acall_attempt(prompt, model, temperature, max_tokens, stop, logprobs, estimated_tokens)
         while True:
             try:
-                response = self.call_api(prompt, model, temperature, max_tokens)
+                if self.hedger is not None:
+                    response = await self.hedger.call(model, attempt_call)
+                else:
+                    response = await attempt_call()
                 break
             except Exception as e:
-                # Handle exceptions
-                print(colored("Error, retrying...", "red"), file=sys.stderr)
-                print(e, file=sys.stderr)
-                time.sleep(1)
+                attempt += 1
+                await asyncio.sleep(self.retry_delay(e, model, attempt))
+        return response
+
+    async def acall_attempt(self, prompt, model, temperature, max_tokens, stop, logprobs, estimated_tokens):
+        await asyncio.sleep(self.rate_limiter.reserve(model, estimated_tokens))
+        start = time.perf_counter()
+        try:
+            response = await self.acall_api(prompt, model, temperature, max_tokens, stop, logprobs)
+        except BaseException as e:
+            # the losing copy of a hedged call is recorded as cancelled
+            self.record_call(model, start, error=e)
+            raise
+        self.record_call(model, start, response=response)
+        self.rate_limiter.settle(model, estimated_tokens, self.used_tokens(response))
+        return response
 
+    def record_call(self, model, start, response=None, error=None):
+        self.metrics.observe("llemba_api_seconds", time.perf_counter() - start, model=model)
+        if error is not None:
+            self.metrics.inc("llemba_api_calls_total", model=model, outcome=error_class(error))
+            return
+        self.metrics.inc("llemba_api_calls_total", model=model, outcome="ok")
+        usage = getattr(response, "usage", None)
+        if getattr(usage, "prompt_tokens", None) is not None:
+            self.metrics.inc("llemba_prompt_tokens_total", usage.prompt_tokens, model=model)
+        if getattr(usage, "completion_tokens", None) is not None:
+            self.metrics.inc("llemba_completion_tokens_total", usage.completion_tokens, model=model)
+
+    # returns how long to wait before the next attempt, or re-raises the error if it should not be retried
+    def retry_delay(self, error, model, attempt):
+        if isinstance(error, CacheMiss):
+            raise error
+        if not is_retryable(error):
+            print(colored(f"Error, not retrying: {error}", "red"), file=sys.stderr)
+            raise error
+        if attempt >= self.max_attempts:
+            print(colored(f"Error, giving up after {attempt} attempts: {error}", "red"), file=sys.stderr)
+            raise error
+
+        self.metrics.inc("llemba_retries_total", model=model, error=error_class(error))
+        retry_after = retry_after_seconds(error)
+        delay = backoff_delay(attempt, retry_after)
+        if error_status_code(error) == 429:
+            self.rate_limiter.pause(model, delay)
+        print(colored(f"Error, retrying in {delay:.1f}s...", "red"), file=sys.stderr)
+        print(error, file=sys.stderr)
+        return delay
+
+    def used_tokens(self, response):
+        usage = getattr(response, "usage", None)
+        return getattr(usage, "total_tokens", None)
+
+    def completion_tokens(self, response):
+        usage = getattr(response, "usage", None)
+        return getattr(usage, "completion_tokens", None)
+
+    def add_tokens(self, a, b):
+        if a is None or b is None:
+            return None
+        return a + b
+
+    def is_truncated(self, answer):
+        # Check if the response didn't finish due to max token limit
+        return str(answer["finish_reason"]).lower() == 'length'
+
+    # whether the backend extends a trailing assistant turn, otherwise a cut off answer is requested again with twice the
+    # budget of the request before
+    def continues_final_message(self):
+        return getattr(self.backend, "continues_final_message", False)
+
+    def replace_answer(self, answer, response):
+        retry = self.parse_response(response)
+        if len(retry) == 0:
+            answer["finish_reason"] = "stop"
+            return
+        answer["answer"] = retry[0]["answer"]
+        answer["finish_reason"] = retry[0]["finish_reason"]
+
+    def continue_answer(self, answer, response):
+        continuation = self.parse_response(response)
+        if self.verbose:
+            print(colored(f"Continuing answer cut off by max tokens: ", "red") + colored(answer["answer"], "blue"), file=sys.stderr)
+        if len(continuation) == 0:
+            # nothing more was generated, keep what we have
+            answer["finish_reason"] = "stop"
+            return
+        answer["answer"] += continuation[0]["answer"]
+        answer["finish_reason"] = continuation[0]["finish_reason"]
+
+    # returns the raw text of every choice, answers are stripped only once they are complete
+    def parse_response(self, response):
         answers = []
         # Access the choices attribute directly
         for choice in response.choices:
             # Access the message content directly
             if hasattr(choice, 'message') and choice.message.content is not None:
-                answer = choice.message.content.strip()
+                answer = choice.message.content
             elif hasattr(choice, 'delta') and choice.delta.content is not None:
-                answer = choice.delta.content.strip()
+                answer = choice.delta.content
             else:
-                answer = choice.text.strip() if hasattr(choice, 'text') else None
+                answer = choice.text if hasattr(choice, 'text') else None
 
-            if not answer:
+            if not answer or not answer.strip():
                 continue
 
-            # Check if the response didn't finish due to max token limit
-            finish_reason = choice.finish_reason
-
-            # Only increase max_tokens if finish_reason is 'length' (i.e., response was cut off)
-            if str(finish_reason).lower() == 'length':
-                if self.verbose:
-                    print(colored(f"Increasing max tokens to fit answers.", "red") + colored(answer, "blue"), file=sys.stderr)
-                    print(f"Finish reason: {finish_reason}", file=sys.stderr)
-                if max_tokens is None:
-                    max_tokens = 0
-                return self.request_api(prompt, model, temperature=temperature, max_tokens=max_tokens + 200)
-            else:
-                # Acceptable finish reason, proceed
-                pass
-
             answers.append({
                 "answer": answer,
-                "finish_reason": finish_reason,
+                "finish_reason": choice.finish_reason,
             })
 
+        return answers
+
+    def finalize_answers(self, answers):
+        answers = [dict(answer, answer=answer["answer"].strip()) for answer in answers]
+
         if len(answers) > 1:
             # Remove duplicate answers
             answers = [dict(t) for t in {tuple(d.items()) for d in answers}]
 
         return answers
 
-    def call_api(self, prompt, model, temperature, max_tokens):
-        parameters = {
-            "model": model,
-            "temperature": temperature,
-            "top_p": 1.0,
-            "top_k": 50,
-            "repetition_penalty": 1.0,
-            "stop": ["<|eot_id|>", "<|eom_id|>"],
-            "stream": False,
-        }
-
-        if max_tokens is not None:
-            parameters["max_tokens"] = max_tokens
-
-        if isinstance(prompt, list):
-            # Check that prompt contains a list of dictionaries with role and content
-            assert all(isinstance(p, dict) for p in prompt), "Prompts must be a list of dictionaries."
-            assert all("role" in p and "content" in p for p in prompt), "Prompts must be a list of dictionaries with role and content."
-            parameters["messages"] = prompt
-        else:
-            parameters["messages"] = [{"role": "user", "content": prompt}]
+    def call_api(self, prompt, model, temperature, max_tokens, stop=None, logprobs=None):
+        parameters = build_parameters(prompt, model, temperature, max_tokens, stop, logprobs)
+        return self.backend.create(**parameters)
 
-        # Use the correct method for chat completion
-        return self.client.chat.completions.create(**parameters)
+    async def acall_api(self, prompt, model, temperature, max_tokens, stop=None, logprobs=None):
+        parameters = build_parameters(prompt, model, temperature, max_tokens, stop, logprobs)
+        return await self.backend.acreate(**parameters)
 
-    def bulk_request(self, df, model, parse_mqm_answer, cache, max_tokens=None):
+    # the answers refer to their prompt by its position in df as prompt_id
+    def bulk_request(self, df, model, parse_mqm_answer, cache, max_tokens=None, concurrency=1):
         answers = []
-        for i, row in tqdm.tqdm(df.iterrows(), total=len(df), file=sys.stderr):
-            prompt = row["prompt"]
-            parsed_answers = self.request(prompt, model, parse_mqm_answer, cache=cache, max_tokens=max_tokens)
-            answers += parsed_answers
-        return answers
\ No newline at end of file
+        for prompt_id, parsed_answers in enumerate(self.iter_bulk_request(df["prompt"], model, parse_mqm_answer, cache, max_tokens=max_tokens, concurrency=concurrency, total=len(df))):
+            # identical prompts share their answers, each row gets its own copy
+            answers += [dict(answer, prompt_id=prompt_id) for answer in parsed_answers]
+        return answers
+
+    # yields the parsed answers of each prompt in input order as soon as they are ready, prompts can be a lazy iterator
+    def iter_bulk_request(self, prompts, model, parse_mqm_answer, cache, max_tokens=None, concurrency=1, window=None, total=None):
+        jobs = ({"prompt": prompt, "parse_response": parse_mqm_answer, "max_tokens": max_tokens} for prompt in prompts)
+        yield from self.iter_bulk_jobs(jobs, model, cache, concurrency=concurrency, window=window, total=total)
+
+    # the kind of request is told by the keys of the job: pairs for request_packed(), values for request_expected()
+    def run_job(self, job, model, cache):
+        if "pairs" in job:
+            return self.request_packed(model=model, cache=cache, **job)
+        if "values" in job:
+            return self.request_expected(model=model, cache=cache, **job)
+        return self.request(model=model, cache=cache, **job)
+
+    async def arun_job(self, job, model, cache):
+        if "pairs" in job:
+            return await self.arequest_packed(model=model, cache=cache, **job)
+        if "values" in job:
+            return await self.arequest_expected(model=model, cache=cache, **job)
+        return await self.arequest(model=model, cache=cache, **job)
+
+    # like iter_bulk_request, but every job is a dict of keyword arguments of request() (prompt, parse_response, max_tokens,
+    # stop) so that several methods share one run, of request_packed() (prompts, pairs, packed_template, ...) or of
+    # request_expected() (prompt, values)
+    def iter_bulk_jobs(self, jobs, model, cache, concurrency=1, window=None, total=None):
+        import tqdm
+
+        progress = tqdm.tqdm(total=total, file=sys.stderr)
+        try:
+            if concurrency <= 1:
+                for job in jobs:
+                    yield self.run_job(job, model, cache)
+                    progress.update(1)
+                return
+
+            # drive the async generator from a private event loop so that callers can stay synchronous
+            loop = asyncio.new_event_loop()
+            agen = self.aiter_bulk_jobs(jobs, model, cache, concurrency=concurrency, window=window)
+            try:
+                while True:
+                    try:
+                        parsed_answers = loop.run_until_complete(agen.__anext__())
+                    except StopAsyncIteration:
+                        break
+                    yield parsed_answers
+                    progress.update(1)
+            finally:
+                loop.run_until_complete(agen.aclose())
+                loop.close()
+        finally:
+            progress.close()
+
+    async def aiter_bulk_jobs(self, jobs, model, cache, concurrency=64, window=None):
+        # at most `concurrency` requests are in flight and at most `window` jobs are buffered, which keeps memory flat
+        if window is None:
+            window = concurrency * 4
+        window = max(window, concurrency)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run(job):
+            async with semaphore:
+                return await self.arun_job(job, model, cache)
+
+        # identical jobs inside the window are collapsed into one task whose answers are fanned out to every row
+        coalesced = {}
+        pending = collections.deque()
+
+        def pop():
+            key, task = pending.popleft()
+            if coalesced.get(key) is task:
+                del coalesced[key]
+            return task
+
+        try:
+            for job in jobs:
+                key = tuple(sorted((name, json.dumps(value, sort_keys=True) if isinstance(value, (list, dict)) else value) for name, value in job.items()))
+                if key not in coalesced:
+                    coalesced[key] = asyncio.ensure_future(run(job))
+                pending.append((key, coalesced[key]))
+                if len(pending) >= window:
+                    yield await pop()
+            while pending:
+                yield await pop()
+        finally:
+            tasks = set(task for _, task in pending)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # async clients are bound to the event loop of this run
+            await self.backend.aclose()
@@ -0,0 +1,34 @@
+import math
+import threading
+import collections
+
+
+class TokenBudgets:
+    # Learns how long the completions for each (model, declared budget) really are and sizes the first request to fit
+    # them, so that short answers are not billed and timed for a budget meant for the worst case
+    def __init__(self, quantile=0.99, headroom=1.25, minimum=8, min_samples=50, history=1000, refresh_every=50):
+        self.quantile = quantile
+        self.headroom = headroom
+        self.minimum = minimum
+        self.min_samples = min_samples
+        self.refresh_every = refresh_every
+        self.observed = collections.defaultdict(lambda: collections.deque(maxlen=history))
+        self.tuned = {}
+        self.lock = threading.Lock()
+
+    def first_chunk(self, model, max_tokens):
+        if max_tokens is None:
+            return None
+        return self.tuned.get((model, max_tokens), max_tokens)
+
+    def observe(self, model, max_tokens, completion_tokens):
+        if max_tokens is None or completion_tokens is None:
+            return
+        key = (model, max_tokens)
+        with self.lock:
+            observed = self.observed[key]
+            observed.append(completion_tokens)
+            if len(observed) >= self.min_samples and len(observed) % self.refresh_every == 0:
+                lengths = sorted(observed)
+                length = lengths[int(self.quantile * (len(lengths) - 1))]
+                self.tuned[key] = max(self.minimum, min(max_tokens, math.ceil(length * self.headroom)))
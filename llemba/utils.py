@@ -1,30 +1,183 @@
-import ipdb
-import pandas as pd
-import diskcache as dc
+import itertools
 
 from llemba.together_api import TogetherApi
-from llemba.llemba_mqm_utils import TEMPLATE_LLEMBA_MQM, apply_template, parse_mqm_answer
+from llemba.cache import ResponseCache
+from llemba.results import ResultStore
+from llemba.llemba_mqm_utils import MQM_MAX_TOKENS, TEMPLATE_LLEMBA_MQM, compile_template, parse_mqm_answer
 from llemba.prompt import prompts, validate_number
+from llemba.packing import compile_packed_template
 
+PROMPT_BLOCK_SIZE = 1024
 
-def get_llemba_scores(source, hypothesis, source_lang, target_lang, method, model):
-    df = pd.DataFrame({'source_seg': source, 'target_seg': hypothesis})
-    df['source_lang'] = source_lang
-    df['target_lang'] = target_lang
 
-    cache = dc.Cache(f'cache/{model}_{method}', expire=None, size_limit=int(10e10), cull_limit=0, eviction_policy='none')
-    togetherapi = TogetherApi()
+# module level function rather than a lambda, so that identical MQM jobs are recognised as such when coalescing
+def parse_mqm_score(x):
+    return parse_mqm_answer(x, list_mqm_errors=False, full_desc=True)
 
+
+def get_method(method):
     if method == "LLEMBA-MQM":
-        # df["prompt"] = df.apply(lambda x: apply_template(TEMPLATE_LLEMBA_MQM, x), axis=1)
-        # parse_answer = lambda x: parse_mqm_answer(x, list_mqm_errors=False, full_desc=True)
-        # answers = togetherapi.bulk_request(df, model, parse_answer, cache=cache, max_tokens=500)
-        raise Exception(f"Method {method} not supported.")
+        template = TEMPLATE_LLEMBA_MQM
+        parse_answer = parse_mqm_score
+        # the answer lists errors on several lines, so only the end of turn stops it
+        max_tokens = MQM_MAX_TOKENS
+        stop = None
     elif method in ["LLEMBA-DA", "LLEMBA-DA_ref", "LLEMBA-SQM", "LLEMBA-SQM_ref", "LLEMBA-stars", "LLEMBA-stars_ref", "LLEMBA-classes", "LLEMBA-classes_ref"]:
-        df["prompt"] = df.apply(lambda x: apply_template(prompts[method]['prompt'], x), axis=1)
+        template = prompts[method]['prompt']
         parse_answer = prompts[method]["validate_answer"]
-        answers = togetherapi.bulk_request(df, model, parse_answer, cache=cache, max_tokens=500)
+        max_tokens = prompts[method]["max_tokens"]
+        stop = prompts[method]["stop"]
     else:
         raise Exception(f"Method {method} not supported.")
 
-    return list(pd.DataFrame(answers)['answer'])
+    return template, parse_answer, max_tokens, stop
+
+
+# the prompt and the valid score tokens of a method in the expected-score mode
+def get_expected_method(method):
+    if "expected" not in prompts.get(method, {}):
+        raise Exception(f"Method {method} does not support expected scores.")
+    expected = prompts[method]["expected"]
+    return expected.get("prompt", prompts[method]["prompt"]), expected["values"]
+
+
+def get_llemba_scores(source, hypothesis, source_lang, target_lang, method, model, concurrency=1, togetherapi=None, cache=None):
+    return get_llemba_results(source, hypothesis, source_lang, target_lang, [method], model, concurrency=concurrency, togetherapi=togetherapi, cache=cache).scores(0)
+
+
+# collects the results of all methods into a ResultStore, indexed by segment position and method
+def get_llemba_results(source, hypothesis, source_lang, target_lang, methods, model, concurrency=1, togetherapi=None, cache=None):
+    results = ResultStore(len(source), len(methods))
+    for index, answers in enumerate(iter_llemba_multi_answers(zip(source, hypothesis), source_lang, target_lang, methods, model, concurrency=concurrency, togetherapi=togetherapi, cache=cache, total=len(source))):
+        results.record(index, answers)
+    return results
+
+
+def iter_llemba_scores(pairs, source_lang, target_lang, method, model, concurrency=1, togetherapi=None, cache=None, window=None, total=None):
+    for answer in iter_llemba_answers(pairs, source_lang, target_lang, method, model, concurrency=concurrency, togetherapi=togetherapi, cache=cache, window=window, total=total):
+        yield answer['answer'] if answer is not None else None
+
+
+# pairs is any iterable of (source, hypothesis) tuples, it is consumed lazily and the best answer of every pair is yielded in order
+def iter_llemba_answers(pairs, source_lang, target_lang, method, model, concurrency=1, togetherapi=None, cache=None, window=None, total=None):
+    for answers in iter_llemba_multi_answers(pairs, source_lang, target_lang, [method], model, concurrency=concurrency, togetherapi=togetherapi, cache=cache, window=window, total=total):
+        yield answers[0]
+
+
+# scores every pair with all the given methods in one pass, the requests of all methods are interleaved over one client
+# and the list of the best answers (one per method, in the given order) is yielded for every pair
+# with pack > 1, methods that have a packed prompt score groups of `pack` segments in one request
+# with expected, the scores are expectations over the logprobs of the first answer token (TogetherApi.request_expected)
+def iter_llemba_multi_answers(pairs, source_lang, target_lang, methods, model, concurrency=1, togetherapi=None, cache=None, window=None, total=None, pack=1, expected=False):
+    assert not (expected and pack > 1), "Expected scores are requested one segment at a time."
+    configs = [get_method(method) for method in methods]
+
+    # one cache is shared by all methods and models, entries are keyed by the hash of the full request
+    if cache is None:
+        cache = ResponseCache()
+    if togetherapi is None:
+        togetherapi = TogetherApi()
+
+    # templates are compiled once for the language pair and rendered a block of segments at a time
+    templates = [compile_template(template, source_lang, target_lang) for template, _, _, _ in configs]
+
+    def jobs():
+        for segment_prompts in iter_segment_prompts(pairs, templates):
+            for prompt, (_, parse_answer, max_tokens, stop) in zip(segment_prompts, configs):
+                yield {"prompt": prompt, "parse_response": parse_answer, "max_tokens": max_tokens, "stop": stop}
+
+    def best_answers(answers):
+        # an empty list means that no valid answer was found even at the highest temperature
+        best = [x[0] if len(x) > 0 else None for x in answers]
+        for method, answer in zip(methods, best):
+            togetherapi.metrics.inc("llemba_segments_total", method=method, status=answer_status(answer))
+        return best
+
+    if expected:
+        yield from iter_expected_answers(pairs, source_lang, target_lang, methods, model, togetherapi, cache, concurrency, window, total, best_answers)
+        return
+
+    if pack > 1:
+        yield from iter_packed_answers(pairs, source_lang, target_lang, methods, configs, templates, model, pack, togetherapi, cache, concurrency, window, total, best_answers)
+        return
+
+    results = togetherapi.iter_bulk_jobs(jobs(), model, cache, concurrency=concurrency, window=window, total=total * len(methods) if total is not None else None)
+    while True:
+        answers = list(itertools.islice(results, len(methods)))
+        if not answers:
+            break
+        yield best_answers(answers)
+
+
+# the prompts of all templates for every pair, rendered a block of segments at a time
+def iter_segment_prompts(pairs, templates):
+    iterator = iter(pairs)
+    while True:
+        block = list(itertools.islice(iterator, PROMPT_BLOCK_SIZE))
+        if not block:
+            break
+        source_segs, target_segs = zip(*block)
+        rendered = [template.render_many(source_segs, target_segs) for template in templates]
+        yield from zip(*rendered)
+
+
+def iter_expected_answers(pairs, source_lang, target_lang, methods, model, togetherapi, cache, concurrency, window, total, best_answers):
+    configs = [get_expected_method(method) for method in methods]
+    templates = [compile_template(template, source_lang, target_lang) for template, _ in configs]
+
+    def jobs():
+        for segment_prompts in iter_segment_prompts(pairs, templates):
+            for prompt, (_, values) in zip(segment_prompts, configs):
+                yield {"prompt": prompt, "values": values}
+
+    results = togetherapi.iter_bulk_jobs(jobs(), model, cache, concurrency=concurrency, window=window, total=total * len(methods) if total is not None else None)
+    while True:
+        answers = list(itertools.islice(results, len(methods)))
+        if not answers:
+            break
+        yield best_answers(answers)
+
+
+# one job per method and group of `pack` segments, a packed request for methods with a packed prompt and single requests
+# for the others, every job gives the answers of all segments of its group
+def iter_packed_answers(pairs, source_lang, target_lang, methods, configs, templates, model, pack, togetherapi, cache, concurrency, window, total, best_answers):
+    packed_templates = [compile_packed_template(prompts[method]["packed"], source_lang, target_lang) if "packed" in prompts.get(method, {}) else None for method in methods]
+
+    def jobs():
+        iterator = iter(pairs)
+        while True:
+            group = list(itertools.islice(iterator, pack))
+            if not group:
+                break
+            source_segs, target_segs = zip(*group)
+            for template, packed_template, (_, parse_answer, max_tokens, stop) in zip(templates, packed_templates, configs):
+                yield {"prompts": template.render_many(source_segs, target_segs), "pairs": group, "packed_template": packed_template, "parse_response": parse_answer, "max_tokens": max_tokens, "stop": stop}
+
+    results = togetherapi.iter_bulk_jobs(jobs(), model, cache, concurrency=concurrency, window=window, total=-(-total // pack) * len(methods) if total is not None else None)
+    while True:
+        group_answers = list(itertools.islice(results, len(methods)))
+        if not group_answers:
+            break
+        for answers in zip(*group_answers):
+            yield best_answers(answers)
+
+
+def answer_status(answer):
+    if answer is not None and answer.get("cache_miss"):
+        return "cache_miss"
+    if answer is None or answer["answer"] is None:
+        return "no_answer"
+    return "scored"
+
+
+# counts lines the same way iterating over the file does, reading it in blocks so that memory stays flat
+def count_lines(path):
+    count = 0
+    last = b'\n'
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            count += block.count(b'\n')
+            last = block[-1:]
+    if last != b'\n':
+        count += 1
+    return count
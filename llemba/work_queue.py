@@ -0,0 +1,182 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import itertools
+import threading
+import contextlib
+
+from llemba.utils import iter_llemba_multi_answers
+
+# Work queue in a SQLite file, to score one corpus with any number of worker processes on one or more machines. The
+# coordinator stores the settings of the job and the segments in batches. Workers claim a batch with a lease that
+# expires, renew it while they score, and write the scores of the batch back. A batch whose lease has expired (its
+# worker crashed or hangs) is claimed again by the next worker that asks, and a late result of a worker that lost its
+# lease is dropped. The scores are collected in input order once every batch is done. The queue carries the segments,
+# so workers only need the queue file and the response cache. On several machines the file has to be on a shared
+# filesystem with working locks.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS job (name TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS batches (
+    id INTEGER PRIMARY KEY,
+    start INTEGER NOT NULL,
+    pairs TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_until REAL,
+    claims INTEGER NOT NULL DEFAULT 0,
+    scores TEXT
+);
+CREATE INDEX IF NOT EXISTS batches_state ON batches (state, id);
+"""
+
+
+class WorkQueue:
+    # worker names the holder of the leases taken through this connection, the host and process by default
+    def __init__(self, path, timeout=60.0, worker=None):
+        self.path = path
+        # transactions are started explicitly, so that a claim reads and leases a batch under one write lock
+        self.connection = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self.connection.executescript(SCHEMA)
+        self.worker = worker or f"{socket.gethostname()}:{os.getpid()}"
+
+    @contextlib.contextmanager
+    def transaction(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    # job is a dict of the settings every worker scores with, pairs an iterable of (source, hypothesis) read lazily
+    def enqueue(self, job, pairs, batch_size=1000):
+        iterator = iter(pairs)
+        batches = 0
+        start = 0
+        with self.transaction():
+            if self.connection.execute("SELECT COUNT(*) FROM job").fetchone()[0] > 0:
+                raise ValueError(f"The queue {self.path} already holds a job.")
+            self.connection.executemany("INSERT INTO job (name, value) VALUES (?, ?)", [(name, json.dumps(value)) for name, value in job.items()])
+            while True:
+                batch = list(itertools.islice(iterator, batch_size))
+                if not batch:
+                    break
+                self.connection.execute("INSERT INTO batches (start, pairs) VALUES (?, ?)", (start, json.dumps(batch, ensure_ascii=False)))
+                batches += 1
+                start += len(batch)
+        return batches
+
+    def job(self):
+        return {name: json.loads(value) for name, value in self.connection.execute("SELECT name, value FROM job")}
+
+    # the id, first segment index and pairs of the next pending or expired batch, None if there is none right now
+    def claim(self, lease_seconds):
+        now = time.time()
+        with self.transaction():
+            row = self.connection.execute("SELECT id, start, pairs FROM batches WHERE state = 'pending' OR (state = 'leased' AND lease_until < ?) ORDER BY id LIMIT 1", (now,)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute("UPDATE batches SET state = 'leased', worker = ?, lease_until = ?, claims = claims + 1 WHERE id = ?", (self.worker, now + lease_seconds, row[0]))
+        return row[0], row[1], json.loads(row[2])
+
+    # False if the lease was lost, i.e. the batch has been claimed by another worker in the meantime
+    def renew(self, batch_id, lease_seconds):
+        cursor = self.connection.execute("UPDATE batches SET lease_until = ? WHERE id = ? AND state = 'leased' AND worker = ?", (time.time() + lease_seconds, batch_id, self.worker))
+        return cursor.rowcount == 1
+
+    def complete(self, batch_id, scores):
+        cursor = self.connection.execute("UPDATE batches SET state = 'done', scores = ?, lease_until = NULL WHERE id = ? AND state = 'leased' AND worker = ?", (json.dumps(scores), batch_id, self.worker))
+        return cursor.rowcount == 1
+
+    def counts(self):
+        counts = {"pending": 0, "leased": 0, "done": 0}
+        for state, count in self.connection.execute("SELECT state, COUNT(*) FROM batches GROUP BY state"):
+            counts[state] = count
+        return counts
+
+    # seconds until the first lease of another worker expires, None if no batch is leased
+    def next_expiry(self):
+        lease_until = self.connection.execute("SELECT MIN(lease_until) FROM batches WHERE state = 'leased'").fetchone()[0]
+        return max(lease_until - time.time(), 0.0) if lease_until is not None else None
+
+    # the scores of every segment in input order, only complete once every batch is done
+    def results(self):
+        for (scores,) in self.connection.execute("SELECT scores FROM batches WHERE state = 'done' ORDER BY id"):
+            yield from json.loads(scores)
+
+    def close(self):
+        self.connection.close()
+
+
+class LeaseRenewer:
+    # renews the lease of a batch every third of the lease from a thread with its own connection, so that the lease is
+    # kept while a single segment takes longer than the lease (retries with backoff, a stalled request)
+    def __init__(self, queue, batch_id, lease_seconds):
+        self.path = queue.path
+        self.worker = queue.worker
+        self.batch_id = batch_id
+        self.lease_seconds = lease_seconds
+        self.lost = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        queue = WorkQueue(self.path, worker=self.worker)
+        try:
+            while not self.stopped.wait(self.lease_seconds / 3):
+                if not queue.renew(self.batch_id, self.lease_seconds):
+                    self.lost = True
+                    return
+        finally:
+            queue.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+# scores one batch, None if the lease was lost while scoring
+def score_batch(queue, batch_id, pairs, job, togetherapi, cache, lease_seconds, concurrency=1, window=None):
+    answers = iter_llemba_multi_answers(pairs, job["source_lang"], job["target_lang"], job["methods"], job["model"], concurrency=concurrency, togetherapi=togetherapi, cache=cache,
+                                        window=window, total=len(pairs), pack=job.get("pack", 1), expected=job.get("expected", False))
+    rows = []
+    renewer = LeaseRenewer(queue, batch_id, lease_seconds)
+    try:
+        for segment_answers in answers:
+            if renewer.lost:
+                return None
+            # gaps of a replay are left empty, like in the output of main.py
+            rows.append(['' if answer is not None and answer.get('cache_miss') else answer['answer'] if answer is not None else None for answer in segment_answers])
+    finally:
+        renewer.stop()
+        answers.close()
+    return None if renewer.lost else rows
+
+
+# claims and scores batches until every batch of the queue is done, returns the number of batches this worker scored
+def run_worker(queue, togetherapi, cache, lease_seconds=300.0, concurrency=1, window=None, poll_seconds=5.0, log=None):
+    job = queue.job()
+    scored = 0
+    while True:
+        lease = queue.claim(lease_seconds)
+        if lease is None:
+            counts = queue.counts()
+            if counts["pending"] == 0 and counts["leased"] == 0:
+                return scored
+            # the batches of other workers are waited for, they come back to the queue if their lease expires
+            expiry = queue.next_expiry()
+            time.sleep(min(poll_seconds, expiry + 0.01) if expiry is not None else poll_seconds)
+            continue
+        batch_id, start, pairs = lease
+        rows = score_batch(queue, batch_id, pairs, job, togetherapi, cache, lease_seconds, concurrency=concurrency, window=window)
+        if rows is not None and queue.complete(batch_id, rows):
+            scored += 1
+            if log is not None:
+                log(f"Scored segments {start} to {start + len(pairs) - 1}.")
+        elif log is not None:
+            log(f"Lost the lease of segments {start} to {start + len(pairs) - 1}, they are scored by another worker.")
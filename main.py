@@ -1,22 +1,56 @@
 import os
 import sys
-import ipdb
-import pandas as pd
-import diskcache as dc
+import time
+import collections
 from absl import app, flags
-from llemba.utils import get_llemba_scores
+from llemba.backends import BACKENDS, make_backend
+from llemba.cache import DEFAULT_CACHE_DIR, EVICTION_POLICIES, ResponseCache
 
 
-flags.DEFINE_string('method', None, 'Which method to use?')
+flags.DEFINE_list('method', None, 'Which method to use? Several comma-separated methods are scored in one pass.')
 flags.DEFINE_string('model', None, 'Select Model')
 flags.DEFINE_string('source', None, 'Filepath to the source file.')
 flags.DEFINE_string('hypothesis', None, 'Filepath to the translation file.')
 flags.DEFINE_string('source_lang', None, 'Source language name.')
 flags.DEFINE_string('target_lang', None, 'Target language name.')
+flags.DEFINE_enum('backend', 'together', BACKENDS, 'API to send requests to: Together, an OpenAI-compatible server at --base_url, the in-process fake, or replay to only read the cache.')
+flags.DEFINE_enum('on_cache_miss', 'fail', ['fail', 'gap'], 'With --backend=replay, stop at the first request that is not cached, or leave its score empty and go on.')
+flags.DEFINE_string('base_url', None, 'Base url of the OpenAI-compatible server, e.g. http://localhost:8000/v1.')
+flags.DEFINE_float('fake_latency_ms', 0.0, 'Median latency of the fake backend in milliseconds.')
+flags.DEFINE_float('fake_error_rate', 0.0, 'Share of fake backend requests failing with HTTP 500.')
+flags.DEFINE_float('fake_rate_limit_rate', 0.0, 'Share of fake backend requests failing with HTTP 429.')
+flags.DEFINE_float('fake_stall_rate', 0.0, 'Share of fake backend requests that stall for --fake_stall_seconds.')
+flags.DEFINE_float('fake_stall_seconds', 30.0, 'How long stalled fake backend requests take on top of their latency.')
+flags.DEFINE_float('request_timeout', None, 'Seconds after which a single API request fails and is retried, the client default if not set.')
+flags.DEFINE_float('hedge_quantile', None, 'With --concurrency > 1, send a duplicate of requests slower than this quantile of the recent latencies (e.g. 0.95) and use the first answer. No hedging if not set.')
+flags.DEFINE_float('hedge_budget', 0.05, 'Maximum share of requests that are hedged.')
+flags.DEFINE_integer('concurrency', 1, 'Maximum number of API requests in flight at once.')
+flags.DEFINE_integer('requests_per_minute', None, 'Request budget per minute for the model, unlimited if not set.')
+flags.DEFINE_integer('tokens_per_minute', None, 'Token budget (prompt + completion) per minute for the model, unlimited if not set.')
+flags.DEFINE_integer('max_attempts', 8, 'How many times a failing API request is tried before giving up.')
+flags.DEFINE_integer('pack', 1, 'Number of segments scored in one request by the methods with a packed prompt (LLEMBA-DA, LLEMBA-SQM, LLEMBA-stars).')
+flags.DEFINE_bool('expected_score', False, 'Score from the logprobs of a single answer token, as the expectation over the valid scores (LLEMBA-DA, LLEMBA-SQM, LLEMBA-stars, LLEMBA-classes).')
+flags.DEFINE_integer('window', None, 'Maximum number of segments buffered while scoring, defaults to four times the concurrency.')
+flags.DEFINE_string('output', None, 'File to write the scores to, one per line. Defaults to stdout.')
+flags.DEFINE_string('cache_dir', DEFAULT_CACHE_DIR, 'Directory of the response cache, shared by all methods and models.')
+flags.DEFINE_float('cache_size_gb', 10, 'Size limit of the response cache in GiB, older entries are evicted beyond it.')
+flags.DEFINE_enum('cache_eviction', 'least-recently-stored', EVICTION_POLICIES, 'Eviction policy of the response cache.')
+flags.DEFINE_string('journal_dir', 'journal', 'Directory of the checkpoint journals that record every finished segment.')
+flags.DEFINE_bool('resume', False, 'Resume an interrupted run, segments already in its journal are not scored again.')
+flags.DEFINE_string('emit_batch', None, 'Instead of calling the API, write the requests that are not cached to this batch JSONL file (custom_id is the cache key).')
+flags.DEFINE_string('ingest_batch', None, 'Store the answers of this batch result file in the cache, then score from the cache.')
+flags.DEFINE_string('metrics_json', None, 'File to write a JSON summary of the run metrics to (latencies, tokens, cache hits, retries, escalations).')
+flags.DEFINE_string('metrics_prom', None, 'Prometheus textfile to write the run metrics to, e.g. for the node_exporter textfile collector.')
+flags.DEFINE_float('metrics_interval', 15.0, 'Seconds between updates of the metrics files while the run is going.')
+flags.DEFINE_string('queue', None, 'SQLite work queue shared by several workers. With --source and --hypothesis the job is enqueued, see --worker and --collect.')
+flags.DEFINE_bool('worker', False, 'Claim and score batches of the --queue until all of them are done.')
+flags.DEFINE_bool('collect', False, 'Write the scores of a finished --queue to --output, in input order.')
+flags.DEFINE_integer('queue_batch_size', 1000, 'Segments per batch of the work queue.')
+flags.DEFINE_float('lease_seconds', 300.0, 'Lease of a worker on a batch, renewed while it scores. Batches of workers that stop renewing go back to the queue.')
+flags.DEFINE_string('profile', None, 'File to write cProfile statistics of the scoring loop to, readable with pstats or snakeviz.')
 
 
-def main(argv):
-    FLAGS = flags.FLAGS
+def check_inputs(FLAGS, count_lines):
     assert FLAGS.source is not None, "Source file must be provided."
     assert FLAGS.hypothesis is not None, "Hypothesis file must be provided."
 
@@ -30,21 +64,193 @@ def main(argv):
 
     assert FLAGS.source_lang is not None, "Source language name must be provided."
     assert FLAGS.target_lang is not None, "Target language name must be provided."
+    assert FLAGS.method, "Method must be provided."
+
+    # count the lines up front so that a mismatch is reported before anything is scored, without loading the files
+    num_lines = count_lines(FLAGS.source)
+    assert num_lines == count_lines(FLAGS.hypothesis), "Source and hypothesis files must have the same number of lines."
+    return num_lines
+
+
+# the coordinator stores the job settings and all segments in the queue, so workers do not need the input files
+def enqueue(FLAGS, num_lines):
+    from llemba.work_queue import WorkQueue
+
+    queue = WorkQueue(FLAGS.queue)
+    job = {"source_lang": FLAGS.source_lang, "target_lang": FLAGS.target_lang, "methods": FLAGS.method, "model": FLAGS.model, "pack": FLAGS.pack, "expected": FLAGS.expected_score}
+    try:
+        with open(FLAGS.source, 'r') as source, open(FLAGS.hypothesis, 'r') as hypothesis:
+            batches = queue.enqueue(job, zip((x.strip() for x in source), (x.strip() for x in hypothesis)), batch_size=FLAGS.queue_batch_size)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    finally:
+        queue.close()
+    print(f"Enqueued {num_lines} segments in {batches} batches to {FLAGS.queue}, start workers with --queue={FLAGS.queue} --worker.", file=sys.stderr)
+
+
+def collect(path, output_path):
+    from llemba.work_queue import WorkQueue
+
+    queue = WorkQueue(path)
+    try:
+        counts = queue.counts()
+        if counts["pending"] > 0 or counts["leased"] > 0:
+            print(f"The queue {path} is not finished: {counts['done']} batches are done, {counts['leased']} leased and {counts['pending']} pending.", file=sys.stderr)
+            sys.exit(1)
+        output = open(output_path, 'w') if output_path is not None else sys.stdout
+        for scores in queue.results():
+            print('\t'.join(str(score) for score in scores), file=output)
+        if output is not sys.stdout:
+            output.close()
+    finally:
+        queue.close()
+
+
+def main(argv):
+    # imported here so that --help and argument errors do not wait for the API client
+    from llemba.utils import count_lines, iter_llemba_multi_answers
+    from llemba.journal import Journal, journal_path
+    from llemba.together_api import TogetherApi
+    from llemba.rate_limiter import RateLimiter
+    from llemba.backends import CacheMiss
+    from llemba.metrics import Metrics
+    from llemba.hedging import Hedger
+    from llemba.batch import BatchRecorder, ingest_batch
+
+    FLAGS = flags.FLAGS
+    if FLAGS.worker or FLAGS.collect:
+        assert FLAGS.queue is not None, "The work queue must be provided with --queue."
+    if FLAGS.collect:
+        collect(FLAGS.queue, FLAGS.output)
+        return
+    if not FLAGS.worker:
+        num_lines = check_inputs(FLAGS, count_lines)
+        if FLAGS.queue is not None:
+            enqueue(FLAGS, num_lines)
+            return
+
+    # a batch job answers every request on its own, the packed requests would never be read back
+    assert FLAGS.pack == 1 or (FLAGS.emit_batch is None and FLAGS.ingest_batch is None), "--pack cannot be used with --emit_batch or --ingest_batch."
+
+    rate_limiter = RateLimiter(requests_per_minute=FLAGS.requests_per_minute, tokens_per_minute=FLAGS.tokens_per_minute)
+    on_cache_miss = FLAGS.on_cache_miss
+    if FLAGS.emit_batch is not None:
+        # requests that are not cached go to the batch file and their scores are left empty for now
+        backend = BatchRecorder(FLAGS.emit_batch)
+        on_cache_miss = 'gap'
+    elif FLAGS.ingest_batch is not None:
+        backend = make_backend('replay')
+        on_cache_miss = 'gap'
+    elif FLAGS.backend == 'fake':
+        backend = make_backend('fake', timeout=FLAGS.request_timeout, latency_ms=FLAGS.fake_latency_ms, error_rate=FLAGS.fake_error_rate, rate_limit_rate=FLAGS.fake_rate_limit_rate,
+                               stall_rate=FLAGS.fake_stall_rate, stall_seconds=FLAGS.fake_stall_seconds)
+    else:
+        backend = make_backend(FLAGS.backend, base_url=FLAGS.base_url, timeout=FLAGS.request_timeout)
+    metrics = Metrics()
+    hedger = Hedger(quantile=FLAGS.hedge_quantile, budget=FLAGS.hedge_budget, metrics=metrics) if FLAGS.hedge_quantile is not None else None
+    togetherapi = TogetherApi(rate_limiter=rate_limiter, max_attempts=FLAGS.max_attempts, backend=backend, on_cache_miss=on_cache_miss, metrics=metrics, hedger=hedger)
+    if FLAGS.backend == 'replay':
+        if not os.path.isdir(FLAGS.cache_dir):
+            print(f"Cache directory {FLAGS.cache_dir} does not exist, there is nothing to replay.", file=sys.stderr)
+            sys.exit(1)
+        # a replay must not change the size limit or eviction policy of the cache it reads
+        cache = ResponseCache(FLAGS.cache_dir, size_limit=None, eviction_policy=None)
+    else:
+        cache = ResponseCache(FLAGS.cache_dir, size_limit=FLAGS.cache_size_gb * 2 ** 30, eviction_policy=FLAGS.cache_eviction)
+
+    if FLAGS.ingest_batch is not None:
+        counts = ingest_batch(togetherapi, cache, FLAGS.ingest_batch)
+        print(f"Ingested {counts['ingested']} answers from {FLAGS.ingest_batch}, {counts['existing']} were already cached and {counts['failed']} failed.", file=sys.stderr)
 
-    # load both files and strip them
-    with open(FLAGS.source, 'r') as f:
-        source = f.readlines()
-    source = [x.strip() for x in source]
-    with open(FLAGS.hypothesis, 'r') as f:
-        hypothesis = f.readlines()
-    hypothesis = [x.strip() for x in hypothesis]
+    if FLAGS.worker:
+        from llemba.work_queue import WorkQueue, run_worker
 
-    assert len(source) == len(hypothesis), "Source and hypothesis files must have the same number of lines."
+        queue = WorkQueue(FLAGS.queue)
+        try:
+            scored = run_worker(queue, togetherapi, cache, lease_seconds=FLAGS.lease_seconds, concurrency=FLAGS.concurrency, window=FLAGS.window, log=lambda message: print(message, file=sys.stderr))
+        finally:
+            if FLAGS.metrics_json is not None:
+                metrics.write_json(FLAGS.metrics_json)
+            if FLAGS.metrics_prom is not None:
+                metrics.write_prometheus(FLAGS.metrics_prom)
+            queue.close()
+            cache.close()
+        print(f"The queue {FLAGS.queue} is done, this worker scored {scored} batches.", file=sys.stderr)
+        return
 
-    answers = get_llemba_scores(source, hypothesis, FLAGS.source_lang, FLAGS.target_lang, FLAGS.method, FLAGS.model)
+    journal = Journal(journal_path(FLAGS.journal_dir, FLAGS.source, FLAGS.hypothesis, FLAGS.source_lang, FLAGS.target_lang, FLAGS.method, FLAGS.model, FLAGS.pack, FLAGS.expected_score), resume=FLAGS.resume)
+    completed = dict(journal.completed)
+    if completed:
+        print(f"Resuming, {len(completed)} of {num_lines} segments are already scored.", file=sys.stderr)
 
-    for answer in answers:
-        print(answer)
+    def write_metrics():
+        if FLAGS.metrics_json is not None:
+            metrics.write_json(FLAGS.metrics_json)
+        if FLAGS.metrics_prom is not None:
+            metrics.write_prometheus(FLAGS.metrics_prom)
+
+    profile = None
+    if FLAGS.profile is not None:
+        import cProfile
+        profile = cProfile.Profile()
+
+    output = open(FLAGS.output, 'w') if FLAGS.output is not None else sys.stdout
+    gaps = 0
+    last_write = time.monotonic()
+    if profile is not None:
+        profile.enable()
+    try:
+        # both files are read lazily and every score is written as soon as it is ready
+        with open(FLAGS.source, 'r') as source, open(FLAGS.hypothesis, 'r') as hypothesis:
+            pairs = zip((x.strip() for x in source), (x.strip() for x in hypothesis))
+
+            # indices of the pairs handed to the scorer, which reads ahead of the output
+            pending = collections.deque()
+
+            def remaining():
+                for i, pair in enumerate(pairs):
+                    if i not in completed:
+                        pending.append(i)
+                        yield pair
+
+            answers = iter_llemba_multi_answers(remaining(), FLAGS.source_lang, FLAGS.target_lang, FLAGS.method, FLAGS.model, concurrency=FLAGS.concurrency, togetherapi=togetherapi, cache=cache, window=FLAGS.window, total=num_lines - len(completed), pack=FLAGS.pack, expected=FLAGS.expected_score)
+            for i in range(num_lines):
+                if i in completed:
+                    scores = completed[i]
+                else:
+                    segment_answers = next(answers)
+                    assert pending.popleft() == i
+                    scores = [answer['answer'] if answer is not None else None for answer in segment_answers]
+                    temperatures = [answer['temperature'] if answer is not None else None for answer in segment_answers]
+                    if any(answer is not None and answer.get('cache_miss') for answer in segment_answers):
+                        # a gap is left empty and not journaled, so that a later run with a backend can fill it in
+                        gaps += 1
+                        scores = ['' if answer is not None and answer.get('cache_miss') else score for answer, score in zip(segment_answers, scores)]
+                    else:
+                        journal.append(i, scores, temperature=temperatures)
+                # one row per segment with a tab-separated column per method
+                print('\t'.join(str(score) for score in scores), file=output, flush=True)
+                if time.monotonic() - last_write > FLAGS.metrics_interval:
+                    write_metrics()
+                    last_write = time.monotonic()
+    except CacheMiss as e:
+        print(f"{e} Replay stopped at the first cache miss, use --on_cache_miss=gap to skip misses.", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        if profile is not None:
+            profile.disable()
+            profile.dump_stats(FLAGS.profile)
+        write_metrics()
+        journal.close()
+        cache.close()
+        if output is not sys.stdout:
+            output.close()
+    if FLAGS.emit_batch is not None:
+        backend.close()
+        print(f"Wrote {len(backend.recorded)} requests to {FLAGS.emit_batch}, submit it and pass the results to --ingest_batch.", file=sys.stderr)
+    if gaps:
+        print(f"{gaps} of {num_lines} segments were not in the cache and are left empty.", file=sys.stderr)
 
 if __name__ == "__main__":
     app.run(main)
\ No newline at end of file
@@ -35,6 +35,6 @@ answers = together_api.bulk_request(df, model, parse_response, cache=cache)
 
 # Print the answers
 for ans in answers:
-    print(f"Prompt: {ans['prompt']}")
+    print(f"Prompt: {prompts[ans['prompt_id']]}")
     print(f"Answer: {ans['answer']}")
     print('-' * 50)
\ No newline at end of file
@@ -0,0 +1,12 @@
+import pandas as pd
+
+from llemba.backends import FakeBackend
+from llemba.together_api import TogetherApi
+from llemba.prompt import parse_numerical_answer
+
+
+def test_duplicate_prompts_keep_their_prompt_ids():
+    for concurrency in [1, 8]:
+        df = pd.DataFrame({"prompt": [[{"role": "user", "content": content}] for content in ["a", "b", "a", "a"]]})
+        answers = TogetherApi(backend=FakeBackend()).bulk_request(df, 'm', parse_numerical_answer, {}, concurrency=concurrency)
+        assert [answer["prompt_id"] for answer in answers] == [0, 1, 2, 3]
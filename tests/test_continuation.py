@@ -0,0 +1,26 @@
+from llemba.backends import FakeBackend, OpenAICompatibleBackend
+from llemba.together_api import TogetherApi
+
+ANSWER = " ".join(f"word{i}" for i in range(20))
+
+
+class RerequestingBackend(FakeBackend):
+    # like a backend that would answer a trailing assistant turn with a new turn
+    continues_final_message = False
+
+
+def test_cut_off_answers_are_continued_or_requested_again():
+    for backend in [FakeBackend(answers={"prompt": ANSWER}), RerequestingBackend(answers={"prompt": ANSWER})]:
+        answers = TogetherApi(backend=backend).request_api("prompt", "m", max_tokens=6)
+        assert answers[0]["answer"] == ANSWER
+        assert answers[0]["finish_reason"] != "length"
+    # 6, 12 and 24 tokens
+    assert backend.num_calls == 3
+
+
+def test_openai_body_continues_final_message():
+    backend = OpenAICompatibleBackend("http://localhost:8000/v1")
+    messages = [{"role": "user", "content": "prompt"}, {"role": "assistant", "content": "word0"}]
+    body = backend.body({"model": "m", "messages": messages})
+    assert body["continue_final_message"] is True and body["add_generation_prompt"] is False
+    assert "continue_final_message" not in backend.body({"model": "m", "messages": messages[:1]})
@@ -0,0 +1,30 @@
+import math
+
+import pytest
+
+from llemba.backends import FakeBackend
+from llemba.expected import first_token_logprobs
+from llemba.prompt import SCORE_TOKENS
+from llemba.together_api import TogetherApi
+
+TOP_LOGPROBS = {"80": math.log(0.5), "90": math.log(0.25), "The": math.log(0.25)}
+
+
+def together_response(logprobs=None, top_logprobs=None):
+    chat_completion = pytest.importorskip("together.types.chat.chat_completion")
+    return chat_completion.ChatCompletion.model_validate({
+        "id": "id", "created": 0, "model": "m", "object": "chat.completion", "prompt": [],
+        "choices": [{"finish_reason": "length", "message": {"role": "assistant", "content": "80"}, "logprobs": logprobs, "top_logprobs": top_logprobs}],
+        "usage": {"prompt_tokens": 10, "completion_tokens": 1, "total_tokens": 11},
+    })
+
+
+def test_together_top_logprobs():
+    for response in [
+        together_response(logprobs={"tokens": ["80"], "token_logprobs": [math.log(0.5)], "top_logprobs": TOP_LOGPROBS}),
+        together_response(top_logprobs=TOP_LOGPROBS),
+    ]:
+        assert first_token_logprobs(response.choices[0]) == pytest.approx(TOP_LOGPROBS)
+        togetherapi = TogetherApi(backend=FakeBackend())
+        answers = togetherapi.expected_answers(togetherapi.logprob_answers(response), "m", SCORE_TOKENS)
+        assert answers[0]["answer"] == pytest.approx(80 * 2 / 3 + 90 / 3)
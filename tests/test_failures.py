@@ -0,0 +1,23 @@
+from llemba.backends import BackendHTTPError, FakeBackend, default_answer
+from llemba.together_api import TogetherApi
+from llemba.utils import iter_llemba_scores
+
+PAIRS = [(f"source {i}", f"translation {i}") for i in range(10)]
+
+
+# the fourth segment is over the context length of the model
+def rule(parameters):
+    if "translation 3" in parameters["messages"][-1]["content"]:
+        raise BackendHTTPError(400, body="context length exceeded")
+    return default_answer(parameters)
+
+
+def test_failed_segment_does_not_stop_the_run():
+    for concurrency in [1, 8]:
+        for backend in [FakeBackend(rule=rule), FakeBackend(error_rate=1.0)]:
+            togetherapi = TogetherApi(backend=backend, max_attempts=1)
+            scores = list(iter_llemba_scores(PAIRS, 'Czech', 'English', 'LLEMBA-DA', 'm', concurrency=concurrency, togetherapi=togetherapi, cache={}))
+            assert len(scores) == len(PAIRS)
+            failed = [i for i, score in enumerate(scores) if score is None]
+            assert failed == ([3] if backend.rule is rule else list(range(len(PAIRS))))
+            assert sum(value for (name, _), value in togetherapi.metrics.counters.items() if name == "llemba_failed_requests_total") == len(failed)
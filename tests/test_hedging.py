@@ -0,0 +1,30 @@
+from llemba.backends import FakeBackend
+from llemba.hedging import Hedger
+from llemba.metrics import Metrics
+from llemba.rate_limiter import RateLimiter
+from llemba.together_api import TogetherApi
+from llemba.utils import iter_llemba_scores
+
+
+class CountingRateLimiter(RateLimiter):
+    def __init__(self):
+        super().__init__()
+        self.reserved = 0
+
+    def reserve(self, model, tokens=0):
+        self.reserved += 1
+        return super().reserve(model, tokens)
+
+
+def test_hedges_are_rate_limited_and_recorded():
+    backend = FakeBackend(latency_ms=2, stall_rate=0.2, stall_seconds=0.05)
+    metrics = Metrics()
+    rate_limiter = CountingRateLimiter()
+    hedger = Hedger(quantile=0.5, budget=1.0, min_samples=10, metrics=metrics)
+    togetherapi = TogetherApi(backend=backend, rate_limiter=rate_limiter, metrics=metrics, hedger=hedger)
+    pairs = [(f"source {i}", f"translation {i}") for i in range(200)]
+    for _ in iter_llemba_scores(pairs, 'Czech', 'English', 'LLEMBA-DA', 'm', concurrency=16, togetherapi=togetherapi, cache={}):
+        pass
+    calls = sum(value for (name, _), value in metrics.counters.items() if name == "llemba_api_calls_total")
+    assert hedger.hedges > 0
+    assert rate_limiter.reserved == backend.num_calls == calls
@@ -0,0 +1,17 @@
+from llemba.llemba_mqm_utils import parse_mqm_answer
+
+
+def test_answer_without_severity_sections_is_invalid():
+    for answer in ["31", "I cannot help with that.", "The translation is fine."]:
+        assert parse_mqm_answer(answer) is None
+
+
+def test_answers_with_severity_sections_are_scored():
+    assert parse_mqm_answer("Critical:\nno-error\nMajor:\nno-error\nMinor:\nno-error") == 0
+    assert parse_mqm_answer('Critical:\nno-error\nMajor:\naccuracy/omission - "x"\nMinor:\nfluency/grammar - "y"') == -6
+    assert parse_mqm_answer("") == 0
+
+
+def test_answers_with_only_no_error_lines_score_zero():
+    for answer in ["no-error", "No errors found.", "no-error\nno-error"]:
+        assert parse_mqm_answer(answer) == 0
@@ -0,0 +1,40 @@
+import re
+
+from llemba.backends import FakeBackend, ReplayBackend, default_answer
+from llemba.together_api import TogetherApi
+from llemba.utils import iter_llemba_multi_answers
+
+PAIRS = [(f"source {i}", f"translation {i}") for i in range(20)]
+
+
+# packed answers miss the lines of the second and third segment of every group, which fall back to single requests
+def rule(parameters):
+    content = parameters["messages"][-1]["content"]
+    if "one line per translation" in content:
+        count = len(re.findall(r'^\d+\. \w+ source:', content, re.M))
+        return "\n".join(f"{i}: {50 + i}" for i in range(1, count + 1) if i not in (2, 3))
+    return default_answer(parameters)
+
+
+def score(togetherapi, cache, concurrency=1, pairs=PAIRS):
+    return [answers[0]["answer"] if answers[0] is not None else None for answers in iter_llemba_multi_answers(
+        pairs, 'Czech', 'English', ['LLEMBA-DA'], 'm', concurrency=concurrency, togetherapi=togetherapi, cache=cache, pack=4)]
+
+
+def test_cached_packed_rerun_makes_no_calls():
+    for concurrency in [1, 8]:
+        cache = {}
+        first = score(TogetherApi(backend=FakeBackend(rule=rule)), cache, concurrency)
+        backend = FakeBackend(rule=rule)
+        assert score(TogetherApi(backend=backend), cache, concurrency) == first
+        assert backend.num_calls == 0
+
+
+def test_replay_of_partial_cache_leaves_gaps():
+    for concurrency in [1, 8]:
+        # only the first four groups are cached, the packed request of the last one misses the cache
+        cache = {}
+        first = score(TogetherApi(backend=FakeBackend(rule=rule)), cache, concurrency, PAIRS[:16])
+        togetherapi = TogetherApi(backend=ReplayBackend(), on_cache_miss="gap")
+        assert score(togetherapi, cache, concurrency) == first + [None] * 4
+        assert togetherapi.cache_misses == 4
@@ -0,0 +1,12 @@
+from llemba.backends import FakeBackend
+from llemba.together_api import TogetherApi
+from llemba.utils import get_llemba_scores
+
+
+def test_scores_keep_their_type():
+    source = [f"source {i}" for i in range(5)]
+    hypothesis = [f"translation {i}" for i in range(5)]
+    for method in ['LLEMBA-DA', 'LLEMBA-classes', 'LLEMBA-MQM']:
+        backend = FakeBackend(answers={"Classify": "Most meaning preserved, minor issues"})
+        scores = get_llemba_scores(source, hypothesis, 'Czech', 'English', method, 'm', togetherapi=TogetherApi(backend=backend), cache={})
+        assert all(type(score) is int for score in scores), (method, scores)
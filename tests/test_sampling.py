@@ -0,0 +1,21 @@
+import pytest
+
+from llemba.backends import FakeBackend
+from llemba.sampling import sample_corpus_scores
+from llemba.together_api import TogetherApi
+
+SOURCE = [f"source {i}" for i in range(500)]
+HYPOTHESIS = [f"translation {i}" for i in range(500)]
+
+
+def test_identical_systems_stop_within_the_tolerance():
+    result = sample_corpus_scores(SOURCE, [HYPOTHESIS, list(HYPOTHESIS)], 'Czech', 'English', 'LLEMBA-DA', 'm', tolerance=1.0,
+                                  togetherapi=TogetherApi(backend=FakeBackend()), cache={})
+    assert result["converged"]
+    assert result["requested"] < len(SOURCE)
+    assert result["means"][0] == result["means"][1]
+
+
+def test_tolerance_is_required():
+    with pytest.raises(AssertionError):
+        sample_corpus_scores(SOURCE, [HYPOTHESIS, HYPOTHESIS], 'Czech', 'English', 'LLEMBA-DA', 'm', togetherapi=TogetherApi(backend=FakeBackend()), cache={})
@@ -0,0 +1,46 @@
+import asyncio
+
+from llemba.backends import FakeBackend
+from llemba.together_api import TogetherApi
+
+
+def test_cancelled_caller_does_not_cancel_shared_call():
+    async def run():
+        togetherapi = TogetherApi(backend=FakeBackend())
+        calls = []
+
+        async def call():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return ["answer"]
+
+        first = asyncio.ensure_future(togetherapi.single_flight("key", call))
+        second = asyncio.ensure_future(togetherapi.single_flight("key", call))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        assert await second == ["answer"]
+        assert first.cancelled()
+        assert calls == [1]
+        assert togetherapi.inflight == {}
+
+    asyncio.run(run())
+
+
+def test_call_is_cancelled_with_its_last_caller():
+    async def run():
+        togetherapi = TogetherApi(backend=FakeBackend())
+        finished = []
+
+        async def call():
+            await asyncio.sleep(0.05)
+            finished.append(1)
+
+        callers = [asyncio.ensure_future(togetherapi.single_flight("key", call)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        for caller in callers:
+            caller.cancel()
+        await asyncio.sleep(0.1)
+        assert finished == []
+        assert togetherapi.inflight == {}
+
+    asyncio.run(run())
@@ -0,0 +1,50 @@
+import time
+
+from llemba.backends import FakeBackend, default_answer
+from llemba.together_api import TogetherApi
+from llemba.utils import iter_llemba_scores
+from llemba.work_queue import WorkQueue, run_worker
+
+PAIRS = [(f"source {i}", f"translation {i}") for i in range(25)]
+JOB = {"source_lang": "Czech", "target_lang": "English", "methods": ["LLEMBA-DA"], "model": "m"}
+
+
+def test_collects_scores_in_input_order(tmp_path):
+    queue = WorkQueue(str(tmp_path / "job.db"))
+    assert queue.enqueue(JOB, PAIRS, batch_size=10) == 3
+    assert run_worker(queue, TogetherApi(backend=FakeBackend()), {}, concurrency=4) == 3
+    expected = list(iter_llemba_scores(PAIRS, 'Czech', 'English', 'LLEMBA-DA', 'm', togetherapi=TogetherApi(backend=FakeBackend()), cache={}))
+    assert [row[0] for row in queue.results()] == expected
+    assert queue.counts() == {"pending": 0, "leased": 0, "done": 3}
+
+
+def test_expired_lease_is_claimed_again_and_late_result_dropped(tmp_path):
+    path = str(tmp_path / "job.db")
+    first = WorkQueue(path, worker="first")
+    second = WorkQueue(path, worker="second")
+    first.enqueue(JOB, PAIRS[:5])
+    batch_id, start, pairs = first.claim(lease_seconds=0.05)
+    assert second.claim(lease_seconds=60) is None
+    time.sleep(0.1)
+    assert second.claim(lease_seconds=60)[0] == batch_id
+    assert not first.renew(batch_id, 60)
+    assert not first.complete(batch_id, [[1]] * 5)
+    assert second.complete(batch_id, [[2]] * 5)
+    assert list(first.results()) == [[2]] * 5
+
+
+def test_lease_is_kept_while_a_segment_takes_longer_than_the_lease(tmp_path):
+    path = str(tmp_path / "job.db")
+    queue = WorkQueue(path, worker="slow")
+    queue.enqueue(JOB, PAIRS[:2])
+    other = WorkQueue(path, worker="other")
+    stolen = []
+
+    # every request outlasts the lease, another worker tries to claim the batch meanwhile
+    def rule(parameters):
+        time.sleep(0.5)
+        stolen.append(other.claim(lease_seconds=60))
+        return default_answer(parameters)
+
+    assert run_worker(queue, TogetherApi(backend=FakeBackend(rule=rule)), {}, lease_seconds=0.2) == 1
+    assert stolen == [None, None]